@@ -0,0 +1,225 @@
+"""
+Approximate nearest neighbor index over the normalized facet embeddings
+(MAIN plus the deviations of each facet), for interactive queries across facets.
+
+Each facet gets a k-means inverted file: the unit vectors are clustered with
+spherical k-means, and a query only scores the vectors in the `n_probe` lists
+whose centroids are closest to it. The index is stored next to the embeddings:
+
+	out.embeddings.ivf/vocab                      one word per line
+	out.embeddings.ivf/facets                     one facet name per line
+	out.embeddings.ivf/{facet}.centroids.npy      n_lists x D unit centroids
+	out.embeddings.ivf/{facet}.offsets.npy        start of every list in rows/vectors
+	out.embeddings.ivf/{facet}.rows.npy           word ids, grouped by list
+	out.embeddings.ivf/{facet}.vectors.npy        float32 unit vectors in the same order
+
+python ann_index.py --embeddings-file ../data/aa_temp_grouped/out.embeddings --mode build
+python ann_index.py --embeddings-file ../data/aa_temp_grouped/out.embeddings --mode recall --k 10 --n-probe 8
+python ann_index.py --embeddings-file ../data/aa_temp_grouped/out.embeddings --mode query
+"""
+
+import argparse
+import os
+import sys
+import time
+import logging
+import numpy as np
+from helpful_functions import readEmbeddings, MAIN_FEAT
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+
+def readArgs ():
+	parser = argparse.ArgumentParser (description="approximate nearest neighbor index for the facet embeddings")
+	parser.add_argument ("--embeddings-file", required=True, type=str, help="embeddings file; the index lives next to it")
+	parser.add_argument ("--mode", required=False, type=str, default="query", choices=["build", "recall", "query"], help="build the index, report its recall or answer queries from stdin (default: query)")
+	parser.add_argument ("--facet-names", required=False, type=str, nargs="+", default=None, help="facets to index or query (default: all)")
+	parser.add_argument ("--n-lists", required=False, type=int, default=None, help="number of k-means lists per facet (default: 4 sqrt(V))")
+	parser.add_argument ("--iterations", required=False, type=int, default=10, help="k-means iterations (default: 10)")
+	parser.add_argument ("--k", required=False, type=int, default=10, help="number of neighbors (default: 10)")
+	parser.add_argument ("--n-probe", required=False, type=int, default=8, help="number of lists scanned per query (default: 8)")
+	parser.add_argument ("--queries", required=False, type=int, default=1000, help="number of sampled query words for --mode recall (default: 1000)")
+	parser.add_argument ("--seed", required=False, type=int, default=0, help="random seed for k-means and the query sample")
+	args = parser.parse_args ()
+	return args
+
+def indexPath (embeddings_file):
+	return f"{embeddings_file}.ivf"
+
+def hasIndex (embeddings_file):
+	return os.path.exists (os.path.join (indexPath (embeddings_file), "facets"))
+
+def assignLists (vectors, centroids, block_size=8192):
+	""" The closest centroid (by cosine) of every vector. """
+	assign = np.empty (len (vectors), dtype=np.int64)
+	for start in range (0, len (vectors), block_size):
+		assign[start:start + block_size] = np.argmax (np.dot (vectors[start:start + block_size], centroids.T), axis=1)
+	return assign
+
+def sphericalKMeans (vectors, n_lists, iterations=10, sample_size=50000, rng=None):
+	rng = np.random.default_rng () if rng is None else rng
+	sample = vectors
+	if len (vectors) > sample_size:
+		sample = vectors[np.sort (rng.choice (len (vectors), sample_size, replace=False))]
+	centroids = sample[rng.choice (len (sample), n_lists, replace=False)].copy ()
+	for _ in range (iterations):
+		assign = assignLists (sample, centroids)
+		sums = np.zeros_like (centroids)
+		np.add.at (sums, assign, sample)
+		# restart empty lists from random points
+		empty = np.flatnonzero (np.bincount (assign, minlength=n_lists) == 0)
+		sums[empty] = sample[rng.choice (len (sample), len (empty), replace=False)]
+		centroids = sums / np.linalg.norm (sums, axis=1)[:, np.newaxis]
+	return centroids
+
+def topK (sims, k):
+	""" Positions of the k largest values, in decreasing order. """
+	k = min (k, len (sims))
+	top = np.argpartition (-sims, k - 1)[:k]
+	return top[np.argsort (-sims[top], kind="stable")]
+
+class IVFIndex (object):
+	""" k-means inverted file over the unit vectors of one facet. """
+	def __init__ (self, centroids, offsets, rows, vectors):
+		self.centroids = centroids
+		self.offsets = offsets
+		self.rows = rows
+		self.vectors = vectors
+		# where every word id sits in rows/vectors
+		self.positions = np.empty (len (rows), dtype=np.int64)
+		self.positions[rows] = np.arange (len (rows))
+
+	@classmethod
+	def build (cls, vectors, n_lists=None, iterations=10, rng=None):
+		n_lists = max (1, int (4 * np.sqrt (len (vectors)))) if n_lists is None else n_lists
+		n_lists = min (n_lists, len (vectors))
+		vectors = np.asarray (vectors, dtype=np.float32)
+		centroids = sphericalKMeans (vectors, n_lists, iterations=iterations, rng=rng)
+		assign = assignLists (vectors, centroids)
+		rows = np.argsort (assign, kind="stable")
+		offsets = np.concatenate ([[0], np.cumsum (np.bincount (assign, minlength=n_lists))])
+		return cls (centroids.astype (np.float32), offsets, rows, vectors[rows])
+
+	def vector (self, row):
+		return self.vectors[self.positions[row]]
+
+	def search (self, query, k=10, n_probe=8):
+		""" Approximate top k (word ids, similarities) for a unit query vector. """
+		probes = topK (np.dot (self.centroids, query), n_probe)
+		candidates = np.concatenate ([np.arange (self.offsets[p], self.offsets[p + 1]) for p in probes])
+		sims = np.dot (self.vectors[candidates], query)
+		top = topK (sims, k)
+		return self.rows[candidates[top]], sims[top]
+
+	def exact (self, query, k=10):
+		""" Exact top k, for measuring recall. """
+		sims = np.dot (self.vectors, query)
+		top = topK (sims, k)
+		return self.rows[top], sims[top]
+
+class FacetIndex (object):
+	""" One IVFIndex per facet over a shared vocabulary. """
+	def __init__ (self, vocab, indices):
+		self.vocab = vocab
+		self.w2i = {w: i for i, w in enumerate (vocab)}
+		self.indices = indices
+
+	def query (self, word, facets=None, k=10, n_probe=8):
+		""" facet -> [(word, similarity)] for the nearest neighbors of `word` in each facet. """
+		row = self.w2i[word]
+		facets = list (self.indices) if facets is None else facets
+		results = dict ()
+		for facet in facets:
+			index = self.indices[facet]
+			rows, sims = index.search (index.vector (row), k=k, n_probe=n_probe)
+			results[facet] = [(self.vocab[r], float (s)) for r, s in zip (rows, sims)]
+		return results
+
+	def recall (self, words, k=10, n_probe=8):
+		""" facet -> mean recall@k of the approximate search against the exact one. """
+		recalls = dict ()
+		for facet, index in self.indices.items ():
+			hits = list ()
+			for w in words:
+				query = index.vector (self.w2i[w])
+				approximate, _ = index.search (query, k=k, n_probe=n_probe)
+				exact, _ = index.exact (query, k=k)
+				hits.append (len (set (approximate) & set (exact)) / len (exact))
+			recalls[facet] = float (np.mean (hits))
+		return recalls
+
+def buildIndex (embeddings, facets=None, n_lists=None, iterations=10, seed=0):
+	rng = np.random.default_rng (seed)
+	rows = np.flatnonzero (embeddings.mask[embeddings.f2i[MAIN_FEAT]])
+	facets = list (embeddings) if facets is None else facets
+	indices = dict ()
+	for facet in facets:
+		indices[facet] = IVFIndex.build (embeddings.facetEmbeddings (facet, rows), n_lists=n_lists, iterations=iterations, rng=rng)
+		logging.info (f"Indexed facet {facet} with {len (indices[facet].centroids)} lists")
+	return FacetIndex ([embeddings.vocab[i] for i in rows], indices)
+
+def writeIndex (index, path):
+	os.makedirs (path, exist_ok=True)
+	for facet, ivf in index.indices.items ():
+		np.save (os.path.join (path, f"{facet}.centroids.npy"), ivf.centroids)
+		np.save (os.path.join (path, f"{facet}.offsets.npy"), ivf.offsets)
+		np.save (os.path.join (path, f"{facet}.rows.npy"), ivf.rows)
+		np.save (os.path.join (path, f"{facet}.vectors.npy"), ivf.vectors)
+	with open (os.path.join (path, "vocab"), "w") as fout:
+		for w in index.vocab:
+			fout.write (f"{w}\n")
+	# written last: its presence marks a complete index
+	with open (os.path.join (path, "facets"), "w") as fout:
+		for facet in index.indices:
+			fout.write (f"{facet}\n")
+
+def loadIndex (path, facets=None, mmap_mode="r"):
+	with open (os.path.join (path, "vocab")) as fin:
+		vocab = [line.rstrip ("\n") for line in fin]
+	with open (os.path.join (path, "facets")) as fin:
+		stored = [line.rstrip ("\n") for line in fin]
+	indices = dict ()
+	for facet in (stored if facets is None else facets):
+		indices[facet] = IVFIndex (np.load (os.path.join (path, f"{facet}.centroids.npy")), \
+								   np.load (os.path.join (path, f"{facet}.offsets.npy")), \
+								   np.load (os.path.join (path, f"{facet}.rows.npy")), \
+								   np.load (os.path.join (path, f"{facet}.vectors.npy"), mmap_mode=mmap_mode))
+	return FacetIndex (vocab, indices)
+
+def main (args):
+	path = indexPath (args.embeddings_file)
+	if args.mode == "build":
+		embeddings = readEmbeddings (args.embeddings_file)
+		index = buildIndex (embeddings, facets=args.facet_names, n_lists=args.n_lists, iterations=args.iterations, seed=args.seed)
+		writeIndex (index, path)
+		logging.info (f"Index written to {path}")
+		return
+
+	index = loadIndex (path, facets=args.facet_names)
+	if args.mode == "recall":
+		rng = np.random.default_rng (args.seed)
+		words = [index.vocab[i] for i in rng.choice (len (index.vocab), size=min (args.queries, len (index.vocab)), replace=False)]
+		start = time.time ()
+		for w in words:
+			index.query (w, k=args.k, n_probe=args.n_probe)
+		elapsed = (time.time () - start) / len (words)
+		for facet, recall in index.recall (words, k=args.k, n_probe=args.n_probe).items ():
+			print (f"{facet}\trecall@{args.k}={recall:.4f}")
+		print (f"{1000 * elapsed:.2f} ms per query over {len (index.indices)} facets (n_probe={args.n_probe})")
+		return
+
+	print ("query (ctrl-c to quit): ")
+	line = sys.stdin.readline()
+	while line:
+		word = line.rstrip()
+		if word not in index.w2i:
+			print (f"{word} not in vocab")
+		else:
+			for facet, neighbors in sorted (index.query (word, k=args.k, n_probe=args.n_probe).items ()):
+				print (f"Finding: {word} in {facet}")
+				for w, sim in neighbors:
+					print (f"{w}\t{sim:.3f}")
+				print ()
+		print ("query (ctrl-c to quit): ")
+		line = sys.stdin.readline()
+
+if __name__ == "__main__":
+	main (readArgs ())
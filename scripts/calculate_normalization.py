@@ -62,8 +62,12 @@ def readContextEmbeddings (filename):
 	return embeddings
 
 def main (args):
+	features_file = os.path.join (args.src_dir, args.features_file)
+	facet_names = readFeats (features_file)
+	logging.info (f"Read {len(facet_names)} facets from {features_file}")
+
 	embeddings_file = os.path.join (args.src_dir, args.embeddings_file)
-	embeddings = readEmbeddings (embeddings_file)
+	embeddings = readEmbeddings (embeddings_file, facets=[name for facet in facet_names for name in facet])
 	static_embeddings = embeddings[MAIN_FEAT]
 	logging.info (f"Embeddings read from {embeddings_file}")
 
@@ -71,10 +75,6 @@ def main (args):
 	w2i = {w:i for i,w in enumerate (static_embeddings)}
 	i2w = {i:w for i,w in enumerate (static_embeddings)}
 	logging.info (f"Vocabulary mapping done, total words {len(w2i)}")
-
-	features_file = os.path.join (args.src_dir, args.features_file)
-	facet_names = readFeats (features_file)
-	logging.info (f"Read {len(facet_names)} facets from {features_file}")
 	
 	facets = [f[1] for f in facet_names if len (f) > 1]
 	idx_facets = {facet: i for i,facet in enumerate (facets)}
@@ -0,0 +1,410 @@
+"""
+Binary, memory-mapped store for the geoSGLM embeddings.
+
+The text dump written by the Java trainer is converted once into a single
+facet x vocab x dim array that lives next to the text file:
+
+	out.embeddings.npy       (F, V, D) array of MAIN vectors and facet deviations
+	out.embeddings.mask.npy  (F, V) booleans, True where the dump has a row for (facet, word)
+	out.embeddings.vocab     one word per line, MAIN facet order first
+	out.embeddings.facets    one facet name per line
+	out.embeddings.header    vocab_size and dims from the first line of the dump
+
+Once the store exists, helpful_functions.readEmbeddings picks it up instead of
+parsing the text. The array is opened with mmap_mode="r", so loading is
+instantaneous and concurrent processes share the same pages of the page cache.
+
+python embedding_store.py --embeddings-file ../data/aa_temp_grouped/out.embeddings
+"""
+
+import argparse
+import os
+import math
+import mmap
+import logging
+import multiprocessing
+import fnmatch
+from collections.abc import Mapping
+import numpy as np
+
+MAIN_FACET = "MAIN"
+# precisions supported throughout the pipeline (see precision_check.py for what they cost)
+DTYPES = ["float64", "float32", "float16"]
+# bytes of the text dump read (and split into lines) at once by a parser
+RANGE_BYTES = 4 * 2**20
+
+def readArgs ():
+	parser = argparse.ArgumentParser (description="convert the text embeddings into a memory-mapped store")
+	parser.add_argument ("--embeddings-file", required=True, type=str, help="text embeddings file written by geoSGLM")
+	parser.add_argument ("--store-prefix", required=False, type=str, default=None, help="prefix of the store files (default: the embeddings file itself)")
+	parser.add_argument ("--workers", required=False, type=int, default=None, help="number of parser processes (default: all cores)")
+	parser.add_argument ("--dtype", required=False, type=str, default="float64", choices=DTYPES, help="precision of the stored array (default: float64)")
+	args = parser.parse_args ()
+	return args
+
+def storePaths (prefix):
+	return {"array": f"{prefix}.npy", \
+			"mask": f"{prefix}.mask.npy", \
+			"vocab": f"{prefix}.vocab", \
+			"facets": f"{prefix}.facets", \
+			"header": f"{prefix}.header"}
+
+def hasStore (prefix):
+	""" True if a complete store exists for `prefix` and is not older than the text dump. """
+	paths = storePaths (prefix)
+	if not all (os.path.exists (path) for path in paths.values()):
+		return False
+	if os.path.exists (prefix) and os.path.getmtime (prefix) > os.path.getmtime (paths["array"]):
+		logging.warning (f"Ignoring stale embedding store for {prefix}")
+		return False
+	return True
+
+def matchFacets (facets, patterns=None):
+	""" The facets (in their given order) equal to or matching any of the
+		shell-style `patterns`, e.g. ["MAIN", "T3_*"]; all of them if None.
+	"""
+	if patterns is None:
+		return list (facets)
+	if isinstance (patterns, str):
+		patterns = [patterns]
+	return [f for f in facets if any (fnmatch.fnmatchcase (f, p) for p in patterns)]
+
+def frequentWords (vocab_file, min_count):
+	""" Words with at least `min_count` occurrences in a count<TAB>word vocab file (see makeAAOneFile.py). """
+	words = set ()
+	with open (vocab_file) as fin:
+		for line in fin:
+			parts = line.rstrip ("\n").split ("\t")
+			if len (parts) == 2 and int (parts[0]) >= min_count:
+				words.add (parts[1])
+	return words
+
+def readLines (filename):
+	with open (filename) as fin:
+		return [line.rstrip ("\n") for line in fin]
+
+def writeLines (filename, items):
+	with open (filename, "w") as fout:
+		for item in items:
+			fout.write (f"{item}\n")
+
+class FacetView (Mapping):
+	""" Read-only word -> vector mapping over one facet of the store.
+
+		Behaves like the per-facet dicts returned by the text reader, but the
+		vectors are views into the (memory-mapped) store array.
+	"""
+	def __init__ (self, store, index):
+		self.store = store
+		self.index = index
+
+	def __getitem__ (self, word):
+		i = self.store.w2i[word]
+		if not self.store.mask[self.index, i]:
+			raise KeyError (word)
+		return self.store.array[self.index, i]
+
+	def __contains__ (self, word):
+		i = self.store.w2i.get (word)
+		return i is not None and bool (self.store.mask[self.index, i])
+
+	def __iter__ (self):
+		for i in np.flatnonzero (self.store.mask[self.index]):
+			yield self.store.vocab[i]
+
+	def __len__ (self):
+		return int (self.store.mask[self.index].sum())
+
+class EmbeddingStore (Mapping):
+	""" Facet name -> FacetView mapping backed by a single (F, V, D) array.
+
+		Drop-in replacement for the dict of dicts built by readEmbeddings, with
+		the array, vocabulary and facet indices exposed for vectorized code.
+	"""
+	def __init__ (self, array, facets, vocab, mask, header=None, vocab_size=None):
+		self.array = array
+		self.facets = list (facets)
+		self.vocab = list (vocab)
+		self.mask = mask
+		self.f2i = {f: i for i, f in enumerate (self.facets)}
+		self.w2i = {w: i for i, w in enumerate (self.vocab)}
+		# (vocab_size, dims) as given in the header of the text dump
+		self.header = header if header is not None else (len (self.vocab), array.shape[2])
+		# number of MAIN words in the full dump, which stays put when only a
+		# subset of the words is loaded
+		if vocab_size is None:
+			vocab_size = int (mask[self.f2i[MAIN_FACET]].sum()) if MAIN_FACET in self.f2i else len (self.vocab)
+		self.vocab_size = vocab_size
+		self._norms = None
+		self._activity = None
+
+	def __getitem__ (self, facet):
+		return FacetView (self, self.f2i[facet])
+
+	def __contains__ (self, facet):
+		return facet in self.f2i
+
+	def __iter__ (self):
+		return iter (self.facets)
+
+	def __len__ (self):
+		return len (self.facets)
+
+	def matrix (self, facet):
+		""" The V x D matrix of a facet (a view, not a copy). """
+		return self.array[self.f2i[facet]]
+
+	@property
+	def norms (self):
+		""" (F, V) L2 norms of every row of the array, computed on first use (one facet at a time) and cached. """
+		if self._norms is None:
+			norms = np.empty (self.mask.shape, dtype=self.array.dtype)
+			for i in range (len (self.facets)):
+				norms[i] = np.linalg.norm (self.array[i], ord=2, axis=1)
+			self._norms = norms
+		return self._norms
+
+	@property
+	def activity (self):
+		""" (F, V) booleans, True where the dump has a non-zero row for (facet, word),
+			e.g. where a source-time facet deviates from MAIN for the word.
+		"""
+		if self._activity is None:
+			self._activity = self.mask & (self.norms != 0)
+		return self._activity
+
+	def select (self, facets=None, words=None):
+		""" A store with only the matching facets and the words in `words`.
+
+			Only the selected rows are read (and copied) from the array.
+		"""
+		fidx = [self.f2i[f] for f in matchFacets (self.facets, facets)]
+		words = None if words is None else set (words)
+		widx = list (range (len (self.vocab))) if words is None else [i for i, w in enumerate (self.vocab) if w in words]
+		if words is None:
+			array, mask = self.array[fidx], self.mask[fidx]
+		else:
+			array, mask = self.array[np.ix_ (fidx, widx)], self.mask[np.ix_ (fidx, widx)]
+		return EmbeddingStore (array, \
+							   [self.facets[i] for i in fidx], \
+							   [self.vocab[i] for i in widx], \
+							   mask, \
+							   header=self.header, \
+							   vocab_size=self.vocab_size)
+
+	def facetEmbeddings (self, facet, rows=None, apply_normalization=True):
+		""" MAIN plus the deviations of `facet` (just MAIN for the MAIN facet) for the
+			words in `rows` (all by default), as unit vectors unless told otherwise.
+		"""
+		rows = slice (None) if rows is None else rows
+		mat = np.array (self.array[self.f2i[MAIN_FACET]][rows])
+		if facet != MAIN_FACET:
+			mat += self.array[self.f2i[facet]][rows]
+		if apply_normalization:
+			mat /= np.linalg.norm (mat, ord=2, axis=1)[:, np.newaxis]
+		return mat
+
+	def astype (self, dtype):
+		""" The same store with the array cast to `dtype` (in memory). """
+		return EmbeddingStore (self.array.astype (dtype), self.facets, self.vocab, self.mask, header=self.header, vocab_size=self.vocab_size)
+
+## parallel parser for the text dump
+
+# State shared with the parser workers; set before each pool is forked.
+_rows = None
+_selected = None
+# facet -> whether it matches the selected patterns, filled in by each worker
+_matched = dict ()
+
+def byteRanges (filename, n_ranges):
+	""" Split the body of the text dump into `n_ranges` byte ranges that start and end on line boundaries. """
+	size = os.path.getsize (filename)
+	with open (filename, "rb") as fin:
+		fin.readline ()
+		start = fin.tell ()
+		cuts = [start]
+		for i in range (1, n_ranges):
+			fin.seek (max (start + (size - start) * i // n_ranges, cuts[-1]))
+			fin.readline ()
+			cuts.append (min (fin.tell (), size))
+	cuts.append (size)
+	return [(a, b) for a, b in zip (cuts[:-1], cuts[1:]) if b > a]
+
+def readRange (filename, start, end):
+	with open (filename, "rb") as fin:
+		fin.seek (start)
+		return fin.read (end - start)
+
+def isSelected (facet, word):
+	patterns, words = _selected
+	if facet not in _matched:
+		_matched[facet] = len (matchFacets ([facet.decode ()], patterns)) > 0
+	return _matched[facet] and (words is None or word in words)
+
+def _scanRange (job):
+	""" The facets seen in a byte range (in order), the (facet, word) keys of its
+		selected lines and its number of MAIN lines.
+	"""
+	filename, start, end = job
+	seen, keys, n_main = dict (), list (), 0
+	main_facet = MAIN_FACET.encode ()
+	for line in readRange (filename, start, end).splitlines ():
+		parts = line.split (None, 2)
+		if len (parts) < 3:
+			continue
+		seen.setdefault (parts[0], None)
+		if parts[0] == main_facet:
+			n_main += 1
+		if isSelected (parts[0], parts[1]):
+			keys.append ((parts[0], parts[1]))
+	return list (seen), keys, n_main
+
+def _parseRange (job):
+	""" Parse the selected lines of one byte range into the shared buffer, from row `offset` on. """
+	filename, start, end, offset = job
+	values = list ()
+	for line in readRange (filename, start, end).splitlines ():
+		parts = line.split (None, 2)
+		if len (parts) == 3 and isSelected (parts[0], parts[1]):
+			values.append (parts[2])
+	if len (values) > 0:
+		# one vectorized conversion for the whole range
+		floats = np.fromstring (b" ".join (values), sep=" ")
+		_rows[offset:offset + len (values)] = floats.reshape (len (values), -1)
+	return len (values)
+
+def mapRanges (function, jobs, workers):
+	""" function over every job, in a forked pool unless there is a single worker. """
+	if workers == 1:
+		return list (map (function, jobs))
+	with multiprocessing.get_context ("fork").Pool (workers) as pool:
+		return pool.map (function, jobs)
+
+def parseEmbeddings (filename, workers=None, dtype=None, facets=None, words=None, chunks_per_worker=4):
+	""" Parse the geoSGLM text dump with a process pool.
+
+		The file is cut into byte ranges that are parsed in parallel straight into
+		one preallocated (lines, D) buffer; when the dump lists every facet over the
+		same vocabulary (the trainer's layout) that buffer is the (F, V, D) array
+		without any further copy. `facets` (names or shell patterns) and `words`
+		restrict which lines are converted and kept. `workers` defaults to 1 (no
+		pool), since the scripts calling this often run many at a time; convert
+		the dump into a store with all cores instead. Returns an EmbeddingStore
+		whose `header` holds the (vocab_size, dims) of the first line.
+	"""
+	global _rows, _selected, _matched
+	workers = 1 if workers is None else workers
+	dtype = np.float64 if dtype is None else dtype
+	with open (filename) as fin:
+		parts = fin.readline().split ()
+		header = (int (parts[0]), int (parts[1]))
+		first = fin.readline().split ()
+	dims = len (first) - 2 if len (first) > 2 else header[1]
+
+	# ranges of at most about RANGE_BYTES, so that memory does not grow with the dump
+	n_ranges = max (1, workers * chunks_per_worker, math.ceil (os.path.getsize (filename) / RANGE_BYTES))
+	ranges = byteRanges (filename, n_ranges)
+	# the workers only send back the keys of the lines that are selected
+	_selected = (facets, None if words is None else {w.encode () for w in words})
+	_matched = dict ()
+	try:
+		scans = mapRanges (_scanRange, [(filename, a, b) for a, b in ranges], workers)
+
+		# facets of the whole dump and the selected vocabulary, in file order with MAIN words first
+		all_facets, main_words, other_words = dict (), dict (), dict ()
+		main_facet = MAIN_FACET.encode ()
+		for range_facets, range_keys, _ in scans:
+			all_facets.update ((f, None) for f in range_facets)
+			for f, w in range_keys:
+				if f == main_facet:
+					main_words.setdefault (w, None)
+				else:
+					other_words.setdefault (w, None)
+		selected_vocab = list (main_words) + [w for w in other_words if w not in main_words]
+		n_main = sum (n for _, _, n in scans)
+
+		names = matchFacets ([f.decode () for f in all_facets], facets)
+		selected_facets = [f.encode () for f in names]
+		f2i = {f: i for i, f in enumerate (selected_facets)}
+		w2i = {w: i for i, w in enumerate (selected_vocab)}
+		fid = np.array ([f2i[f] for _, range_keys, _ in scans for f, _ in range_keys], dtype=np.int64)
+		wid = np.array ([w2i[w] for _, range_keys, _ in scans for _, w in range_keys], dtype=np.int64)
+		offsets = np.concatenate ([[0], np.cumsum ([len (range_keys) for _, range_keys, _ in scans])]).astype (int)
+		n_lines = int (offsets[-1])
+		del scans
+
+		# anonymous shared memory, inherited by the forked workers
+		itemsize = np.dtype (dtype).itemsize
+		buffer = mmap.mmap (-1, max (1, n_lines * dims * itemsize))
+		_rows = np.frombuffer (buffer, dtype=dtype, count=n_lines * dims).reshape (n_lines, dims)
+		mapRanges (_parseRange, [(filename, a, b, int (o)) for (a, b), o in zip (ranges, offsets)], workers)
+		rows = _rows
+	finally:
+		_rows, _selected = None, None
+
+	F, V = len (selected_facets), len (selected_vocab)
+	if n_lines == F * V and \
+	   np.array_equal (fid, np.repeat (np.arange (F), V)) and \
+	   np.array_equal (wid, np.tile (np.arange (V), F)):
+		array = rows.reshape (F, V, dims)
+		mask = np.ones ((F, V), dtype=bool)
+	else:
+		array = np.zeros ((F, V, dims), dtype=dtype)
+		mask = np.zeros ((F, V), dtype=bool)
+		array[fid, wid] = rows
+		mask[fid, wid] = True
+
+	return EmbeddingStore (array, \
+						   names, \
+						   [w.decode () for w in selected_vocab], \
+						   mask, \
+						   header=header, \
+						   vocab_size=n_main if n_main > 0 else len (selected_vocab))
+
+def writeStore (store, prefix):
+	paths = storePaths (prefix)
+	writeLines (paths["vocab"], store.vocab)
+	writeLines (paths["facets"], store.facets)
+	writeLines (paths["header"], store.header)
+	np.save (paths["mask"], store.mask)
+	# the array goes in last so that hasStore never sees a partial store
+	tmp_array = paths["array"] + ".tmp.npy"
+	np.save (tmp_array, store.array)
+	os.replace (tmp_array, paths["array"])
+
+def convertEmbeddings (filename, prefix=None, workers=None, dtype=None):
+	""" Convert the text dump in `filename` into a store at `prefix`. """
+	prefix = filename if prefix is None else prefix
+	store = parseEmbeddings (filename, workers=workers, dtype=dtype)
+	writeStore (store, prefix)
+	return store.header
+
+def loadStore (prefix, mmap_mode="r", facets=None, words=None, dtype=None):
+	""" Open the store at `prefix`; with mmap_mode="r" nothing is read until used.
+
+		With `facets` or `words`, only those rows are read into memory (see
+		EmbeddingStore.select). A `dtype` other than the stored one casts what is
+		loaded; convert with --dtype to keep the memory-mapped array small instead.
+	"""
+	paths = storePaths (prefix)
+	array = np.load (paths["array"], mmap_mode=mmap_mode)
+	mask = np.load (paths["mask"])
+	vocab = readLines (paths["vocab"])
+	store_facets = readLines (paths["facets"])
+	header = tuple (int (x) for x in readLines (paths["header"]))
+	store = EmbeddingStore (array, store_facets, vocab, mask, header=header)
+	if facets is not None or words is not None:
+		store = store.select (facets=facets, words=words)
+	if dtype is not None and np.dtype (dtype) != store.array.dtype:
+		store = store.astype (dtype)
+	return store
+
+def main (args):
+	logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+	prefix = args.embeddings_file if args.store_prefix is None else args.store_prefix
+	workers = os.cpu_count () if args.workers is None else args.workers
+	header = convertEmbeddings (args.embeddings_file, prefix, workers=workers, dtype=args.dtype)
+	logging.info (f"Embeddings from {args.embeddings_file} (vocab size {header[0]}, dims {header[1]}) stored at {prefix}.npy")
+
+if __name__ == "__main__":
+	main (readArgs ())
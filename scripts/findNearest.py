@@ -7,115 +7,124 @@ import sys,math,operator
 
 import numpy as np
 from numpy import linalg as LA
-
-def find(word, data, name):
+from helpful_functions import readEmbeddings
+
+class ComposedEmbeddings(object):
+	"""
+	The facet embeddings of a store without materializing them: MAIN is kept
+	once next to each facet's deviations, and normalized facet vectors
+	(MAIN + deviation) are composed on demand, one block of words at a time.
+	A parsed (in memory) store is not kept: only the rows that each facet has
+	are copied out of it. The norms of each facet are computed once and cached.
+	"""
+	def __init__(self, store, facets, block_size=65536):
+		self.vocab=store.vocab
+		self.w2i=store.w2i
+		# a memory-mapped store is read in place; a parsed one may be zero-filled
+		compact=not isinstance(store.array, np.memmap)
+		main=store.array[store.f2i["MAIN"]]
+		self.main=np.array(main) if compact else main
+		main_present=store.mask[store.f2i["MAIN"]]
+		self.deviations={}
+		self.rows={}
+		for facet in facets:
+			if facet == "MAIN":
+				self.rows[facet]=np.flatnonzero(main_present)
+			else:
+				present=store.mask[store.f2i[facet]]
+				deviations=store.array[store.f2i[facet]]
+				if compact:
+					# (rows of the words the facet has, their deviations)
+					dev_rows=np.flatnonzero(present)
+					self.deviations[facet]=(dev_rows, deviations[dev_rows])
+				else:
+					self.deviations[facet]=(None, deviations)
+				self.rows[facet]=np.flatnonzero(main_present | present)
+		self.block_size=block_size
+		self._norms={}
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def vectors(self, facet, rows):
+		mat=np.array(self.main[rows])
+		if facet in self.deviations:
+			dev_rows, deviations=self.deviations[facet]
+			if dev_rows is None:
+				mat += deviations[rows]
+			else:
+				positions=np.minimum(np.searchsorted(dev_rows, rows), max(len(dev_rows)-1, 0))
+				hits=np.flatnonzero(dev_rows[positions] == rows) if len(dev_rows) > 0 else positions[:0]
+				mat[hits] += deviations[positions[hits]]
+		return mat
+
+	def norms(self, facet):
+		if facet not in self._norms:
+			rows=self.rows[facet]
+			self._norms[facet]=np.concatenate([LA.norm(self.vectors(facet, rows[start:start+self.block_size]), 2, axis=1) \
+											   for start in range(0, len(rows), self.block_size)] + [np.zeros(0)])
+		return self._norms[facet]
+
+	def position(self, facet, word):
+		""" Where `word` sits among the words of `facet`, or None. """
+		if word not in self.w2i:
+			return None
+		rows=self.rows[facet]
+		position=np.searchsorted(rows, self.w2i[word])
+		if position < len(rows) and rows[position] == self.w2i[word]:
+			return position
+		return None
+
+	def scores(self, facet, word):
+		""" Cosine similarity of `word` with every word of `facet`, in vocabulary order. """
+		rows=self.rows[facet]
+		norms=self.norms(facet)
+		position=self.position(facet, word)
+		a=self.vectors(facet, rows[position:position+1])[0] / norms[position]
+		scores=np.empty(len(rows))
+		for start in range(0, len(rows), self.block_size):
+			block=self.vectors(facet, rows[start:start+self.block_size]) / norms[start:start+self.block_size, np.newaxis]
+			scores[start:start+self.block_size]=np.dot(block, a)
+		return scores
+
+def find(word, embeddings, name):
 	print (f"Finding: {word} in {name}")
-	scores={}
-	if word not in data:
+	if embeddings.position(name, word) is None:
 		print (f"{word} not in vocab")
 		return
 
-	a=data[word]
-	for word2 in data:
-		try:
-			score=np.inner(a, data[word2])
-			scores[word2]=score
-		except:
-			pass
-
-	sorted_x = sorted(scores.items(), key=lambda x:x[1], reverse=True)
-	for i in range(10):
-		(k,v) = sorted_x[i]
-		print (f"{k}\t{v:.3f}")
+	scores=embeddings.scores(name, word)
+	top=np.argsort(-scores, kind="stable")[:10]
+	for i in top:
+		print (f"{embeddings.vocab[embeddings.rows[name][i]]}\t{scores[i]:.3f}")
 	print ()
 
 # find closest terms for all states
 def bigfind(word, embeddings, expected_facet=None):
 	if expected_facet == None:
 		for n in sorted(embeddings):
-			find(word, embeddings[n], n)
+			find(word, embeddings, n)
 	else:
 		for n in sorted (embeddings):
 			if n == expected_facet:
-				find (word, embeddings[n], n)
-
-# normalize vectors for faster cosine similarity calculation
-def normalize(embeddings):
-	for name in embeddings:
-		for word in embeddings[name]:
-			a=embeddings[name][word]
-			norm=LA.norm(a, 2)
-
-			a /= norm	
-			embeddings[name][word]=a
-
-# get all active facets in embeddings
-def getFacets(filename):
-	file=open(filename)
-
-	facets={}
-	for i,line in enumerate (file):
-		if i > 0:
-			cols=line.rstrip().split(" ")
-			facets[cols[0]]=1
-	file.close()
-
-	# don't count the base facet
-	#del facets["MAIN"]
-
-	return facets.keys()
+				find (word, embeddings, n)
 
 def process(filename, expected_facet=None):
-	file=open(filename)
-
-	embeddings={}
-
-	facets=getFacets(filename)
+	# the memory-mapped store if there is one, otherwise the text file is parsed (one range at a time)
+	store=readEmbeddings(filename)
 
 	# if you want to only consider a few metadata facets and not all 51 states, do that here.  e.g.:
 	# facets=["MA", "PA"]
-
-	for facet in facets:
-		embeddings[facet]={}
-	
-	for line in file:
-		cols=line.rstrip().split(" ")
-		if len(cols) < 10:
-			continue
-
-		facet=cols[0]
-
-		#if facet != "MAIN" and facet not in embeddings:
-		if facet not in embeddings:
-			continue
-
-		word=cols[1]
-		vals=cols[2:]
-		a=np.array(vals, dtype=float);
-		size=len(vals)
-
-		## 
-		# State embeddings for a word = the MAIN embedding for that word *plus* the state-specific deviation
-		# e.g.
-		# "wicked" in MA = wicked/MAIN + wicked/MA
-		##
-
-		if facet == "MAIN":
-			for n in embeddings:
-				if word not in embeddings[n]:
-					embeddings[n][word]=np.zeros(size)
-				
-				embeddings[n][word]+=a
-
-		else:
-			if word not in embeddings[facet]:
-				embeddings[facet][word]=np.zeros(size)
-				
-			embeddings[facet][word]+=a
-		
-	file.close()
-
-	normalize(embeddings)
+	facets=store.facets
+
+	## 
+	# State embeddings for a word = the MAIN embedding for that word *plus* the state-specific deviation
+	# e.g.
+	# "wicked" in MA = wicked/MAIN + wicked/MA
+	##
+	embeddings=ComposedEmbeddings(store, facets)
+	# let go of the parsed array; the composed embeddings only keep the rows they need
+	del store
 
 	print ("query (ctrl-c to quit): ")
 	line = sys.stdin.readline()
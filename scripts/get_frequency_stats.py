@@ -1,7 +1,9 @@
 import argparse
 import os
+import itertools
 from collections import defaultdict
 from helpful_functions import init_dict, source_names, name_changes
+from tokenizer import count_batch
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="get the period and source specific frequencies")
@@ -12,6 +14,7 @@ def readArgs ():
 	parser.add_argument ("--period-freq-file", required=True, type=str, help="file that contains the period frequency")
 	parser.add_argument ("--source-freq-file", required=True, type=str, help="file that contains the source frequency")
 	parser.add_argument ("--periods", required=False, type=int, default=10, help="specify the number of periods")
+	parser.add_argument ("--batch-size", required=False, type=int, default=10000, help="number of documents counted at once (default: 10000)")
 	args = parser.parse_args ()
 	return args
 
@@ -27,34 +30,41 @@ def main (args):
 
 	period_names = [f'T{i}' for i in range (args.periods)]
 
+	i = -1
 	with open (os.path.join (args.dir_path, args.data_file)) as fin:
-		for i, line in enumerate (fin):
-			parts = line.strip().split("\t")
-			source = parts[0].strip("/").split("/")[3]
-			if source in name_changes:
-				source = name_changes[source]
-			period = parts[1]
-			period = parts[1]
-			text = parts[3]
-        
-			for w in text.split():
-				word_freq_vocab[w] += 1
-        
-			for w in set (text.split()):
-				doc_freq_vocab[w] += 1
-            
-			for w in text.split ():
-				if w not in period_freq_vocab:
-					period_freq_vocab[w] = init_dict (period_names)
-				period_freq_vocab[w][period] += 1
-            
-				if w not in source_freq_vocab:
-					source_freq_vocab[w] = init_dict (source_names)
-				source_freq_vocab[w][source] += 1
-            
-			if (i+1) % 50000 == 0:
-				print (f"{i+1} documents processed")
-                
+		while True:
+			lines = list (itertools.islice (fin, args.batch_size))
+			if len (lines) == 0:
+				break
+
+			periods, sources, texts = list (), list (), list ()
+			for line in lines:
+				parts = line.strip().split("\t")
+				source = parts[0].strip("/").split("/")[3]
+				if source in name_changes:
+					source = name_changes[source]
+				periods.append (parts[1])
+				sources.append (source)
+				texts.append (parts[3])
+
+			# every document is split once; counts are added per distinct word
+			for period, source, counts in zip (periods, sources, count_batch (texts)):
+				i += 1
+				for w, count in counts.items ():
+					word_freq_vocab[w] += count
+					doc_freq_vocab[w] += 1
+
+					if w not in period_freq_vocab:
+						period_freq_vocab[w] = init_dict (period_names)
+					period_freq_vocab[w][period] += count
+
+					if w not in source_freq_vocab:
+						source_freq_vocab[w] = init_dict (source_names)
+					source_freq_vocab[w][source] += count
+
+				if (i+1) % 50000 == 0:
+					print (f"{i+1} documents processed")
+
 	print (f"{i+1} documents processed overall")
 
 	with open (os.path.join (args.dir_path, args.word_freq_file), "w") as fout:
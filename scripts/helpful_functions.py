@@ -1,8 +1,9 @@
 import os
-import re
 import math
 import errno
 import numpy as np
+from embedding_store import hasStore, loadStore, parseEmbeddings
+from tokenizer import clean
 
 def walk (from_dir, prefix="", file_ext=".html"):
 	""" Iterator over files in a directory. """
@@ -13,30 +14,8 @@ def walk (from_dir, prefix="", file_ext=".html"):
 					yield os.path.join (dir_path, filename)	
 
 def basic_preprocess (text):
-	text = text.replace (",", " ")
-	text = text.replace (".", " ")
-	text = text.replace ("'", "")
-	text = text.replace ('"', "")
-	text = text.replace (";", " ")
-	text = text.replace (":", " ")
-	text = text.replace ("!", " ")
-	text = text.replace ("?", " ")
-	#text = text.replace ("-", " ")
-	text = text.replace ("[", " ")
-	text = text.replace ("]", " ")
-	text = text.replace ("{", " ")
-	text = text.replace ("}", " ")
-
-	# remove em-dashes
-	text = re.sub (r'\u2014', ' ', text)
-	# remove quotations
-	text = re.sub (r'\u201D', '', text)
-	text = re.sub (r'\u201C', '', text)
-	# replace $ amounts by special token
-	text = re.sub (r"\$\d+(?:\.\d+)?", "<currency>", text)
-	# replace numbers by special token 
-	text = re.sub(r"^(\d+)$",'<number>', text)
-	return text
+	# punctuation, quotes, currency and numbers (see tokenizer.clean)
+	return clean (text)
 
 # Taken from https://stackoverflow.com/a/600612/119527
 def mkdir_p(path):
@@ -56,22 +35,18 @@ def safe_open_w(path):
 
 ## functions that are specific to reading and processing embeddings
 
-def readEmbeddings (filename):
-	embeddings = dict ()
-	with open (filename) as fin:
-		for i, line in enumerate (fin):
-			if i == 0:
-				parts = line.strip().split ()
-				vocab_size, dims = int(parts[0]), int (parts[1])
-			else:
-				parts = line.strip().split ()
-				facet_name = parts[0]
-				word = parts[1]
-				values = np.array(list(map(float, parts[2:])))
-				if facet_name not in embeddings:
-					embeddings[facet_name] = dict ()
-				embeddings[facet_name][word] = values
-	return embeddings
+def readEmbeddings (filename, workers=None, facets=None, words=None, dtype=None):
+	""" Read the embeddings as facet -> word -> vector.
+
+		`facets` (names or shell patterns such as "T3_*") and `words` restrict
+		what is read into memory; None keeps everything. `dtype` sets the
+		precision of the vectors (float64 unless the store was converted otherwise).
+		`workers` parser processes are used for a text dump (default: 1).
+	"""
+	# use the memory-mapped store when one has been built (see embedding_store.py)
+	if hasStore (filename):
+		return loadStore (filename, facets=facets, words=words, dtype=dtype)
+	return parseEmbeddings (filename, workers=workers, facets=facets, words=words, dtype=dtype)
 
 def normalize(embeddings):
 	norms = np.linalg.norm(embeddings, ord=2, axis=1)
@@ -84,6 +59,10 @@ def sigmoid (x):
 def logsigmoid (x):
 	return math.log (sigmoid (x))
 
+def logsigmoid_array (x):
+	""" logsigmoid over an array, computed as -log(1 + exp(-x)) so it neither overflows nor underflows. """
+	return -np.logaddexp (0, -x)
+
 def is_count_greater (values, thresh=5):
 	return sum(values) >= thresh
 
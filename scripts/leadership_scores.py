@@ -6,7 +6,9 @@ import math
 import numpy as np
 import logging
 logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
-from helpful_functions import readEmbeddings, normalize, sigmoid, logsigmoid, MAIN_FEAT
+from helpful_functions import readEmbeddings, normalize, logsigmoid_array, MAIN_FEAT
+from embedding_store import DTYPES
+from shared_arrays import SharedArrays, WorkerPool, wordRanges
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="leadership score calculation")
@@ -17,6 +19,8 @@ def readArgs ():
 	parser.add_argument ("--changes-file", type=str, required=True, help="file contains all the changes")
 	parser.add_argument ("--leaders-file", type=str, required=True, help="file that contains the leadership scores")
 	parser.add_argument ("--lead-types", type=str, nargs="+", required=True, help="short codes for lead types")
+	parser.add_argument ("--dtype", type=str, required=False, default="float64", choices=DTYPES, help="precision of the embeddings (default: float64)")
+	parser.add_argument ("--workers", type=int, required=False, default=1, help="processes scoring shards of the candidate words (default: 1)")
 	args = parser.parse_args ()
 	return args
 
@@ -30,139 +34,226 @@ def readFeats (filename):
 
 	return facet_names
 
-def transform_to_numpy (dict_embeddings, w2i, i2w, activated_facets, apply_normalization=False):
-	if len(activated_facets) == 1 and MAIN_FEAT in activated_facets:
-		mat = np.array([dict_embeddings[MAIN_FEAT][w] for i, w in enumerate (w2i)])
-	else:
-		activated_facets.insert (0, MAIN_FEAT)
-		mat = np.array ([np.sum([dict_embeddings[facet_name][w] \
-								 for facet_name in activated_facets], axis=0) \
-                         for i, w in enumerate (w2i)])
+def transform_to_numpy (dict_embeddings, w2i, i2w, activated_facets, apply_normalization=False, dtype=None):
+	""" MAIN plus the deviations of `activated_facets` for the words of w2i (any subset of the vocabulary). """
+	rows = np.array ([dict_embeddings.w2i[w] for w in w2i], dtype=np.int64)
+	mat = np.array (dict_embeddings.matrix (MAIN_FEAT)[rows])
+	for facet_name in activated_facets:
+		if facet_name != MAIN_FEAT:
+			mat += dict_embeddings.matrix (facet_name)[rows]
+	mat = mat.astype (dtype, copy=False) if dtype is not None else mat
 	if apply_normalization:
 		mat = normalize (mat)
 	return mat
 
-def get_conditional_embeddings (deviations, w2i, i2w, facet_names, apply_normalization=False):
+def get_conditional_embeddings (deviations, w2i, i2w, facet_names, apply_normalization=False, dtype=None):
 	# Calculate the true embeddings based on the deviations.
 	fully_conditional_embeddings = dict ()
 	for facet in facet_names:
-		mat = transform_to_numpy (deviations, w2i, i2w, list(facet), apply_normalization=apply_normalization)
+		mat = transform_to_numpy (deviations, w2i, i2w, list(facet), apply_normalization=apply_normalization, dtype=dtype)
 		if len (facet) == 1 and MAIN_FEAT in facet:
 			fully_conditional_embeddings[MAIN_FEAT] = mat
 		else:
 			fully_conditional_embeddings[tuple(facet[1].split("_"))] = mat
 	return fully_conditional_embeddings
 
-def get_leader_dyads (words, deviations, embeddings, sources, w2i, lead_type):
-	instance_specific_leads = dict ()
-	for i, item in enumerate (words):
-		w,t1,t2,f1,f2 = str(item[0]), int(item[1][1:]), int(item[2][1:]), item[3], item[4]
-		if w in w2i:
-			leads = {(s1, s2, x, y): lead_measurement (deviations, embeddings, w, s1, s2, x, y, f1, f2, w2i, lead_type) \
-									 for s1, s2 in itertools.permutations (sources, 2) \
-									 for x,y in zip (range (t1, t2), range (t1+1, t2+1))}
-
-			leads = {key: leads[key] for key in leads if leads[key] != -np.inf} # keep only those pairs which have leads
-			if len (leads) > 0:
-				key, value = max (leads.items(), key=lambda x:x[1])
-			else:
-				key, value = None, None
-			instance_specific_leads[w] = (key, value)
-	return instance_specific_leads
-
-def lead_measurement (deviations, embeddings, w, s1, s2, t1, t2, f1, f2, w2i, lead_type):
-	# No point in calculating the lead-lag between sources 
-	# that were inactive at t1 and t2.
-	# The following condition checks for that by measuring 
-	# a source-specific deviation at the given times.
-	#if w not in deviations:
-	#	return 1 # This shouldn't really happen but I will debug this later.
-
-	V = len (w2i)
-	k = 50 # I would like to remove this hardcoded code
-	const = math.log (V/k) 
+def candidate_vocab (words, w2i):
+	""" The candidate `words` that are in w2i, renumbered from 0. """
+	candidates = {str(item[0]) for item in words}
+	return {w: i for i, w in enumerate (w for w in w2i if w in candidates)}
+
+def get_lead_embeddings (deviations, w2i, i2w, facet_names, lead_types, dtype=None):
+	""" The unnormalized (l1) and normalized (other lead types) conditional embeddings, None where unused. """
+	embeddings, normalized_embeddings = None, None
+	if "l1" in lead_types:
+		embeddings = get_conditional_embeddings (deviations, w2i, i2w, facet_names, dtype=dtype)
+	if any (lead_type != "l1" for lead_type in lead_types):
+		normalized_embeddings = get_conditional_embeddings (deviations, w2i, i2w, facet_names, apply_normalization=True, dtype=dtype)
+	return embeddings, normalized_embeddings
 
-	if np.linalg.norm (deviations[f"T{t1}_{s1}"][w]) == 0 or \
-	   np.linalg.norm (deviations[f"T{t2}_{s2}"][w]) == 0 or \
-	   np.linalg.norm (deviations[f"T{t1}_{s2}"][w]) == 0:
-		return -np.inf
-    
-	e1 = embeddings[(f"T{t1}",s1)][w2i[w]]
-	e2 = embeddings[(f"T{t2}",s2)][w2i[w]]
-	e3 = embeddings[(f"T{t1}",s2)][w2i[w]]
-     
-	num = np.dot (e1, e2)
-	den = np.dot (e3, e2)
+def get_word_tensors (rows, embeddings, sources, n_times):
+	""" The (W, T, S, D) conditional embeddings of the words in `rows` at every time and source. """
+	main = embeddings[MAIN_FEAT]
+	tensor = np.zeros ((len (rows), n_times, len (sources), main.shape[1]), dtype=main.dtype)
+	for t in range (n_times):
+		for j, s in enumerate (sources):
+			if (f"T{t}", s) in embeddings:
+				tensor[:, t, j] = embeddings[(f"T{t}", s)][rows]
+	return tensor
 
+def get_active_sources (words, deviations, sources, n_times):
+	""" The (W, T, S) mask of the sources active at each time, i.e. with a non-zero deviation for the word. """
+	rows = np.array ([deviations.w2i[w] for w in words], dtype=np.int64)
+	active = np.zeros ((len (words), n_times, len (sources)), dtype=bool)
+	for t in range (n_times):
+		for j, s in enumerate (sources):
+			if f"T{t}_{s}" in deviations:
+				active[:, t, j] = deviations.activity[deviations.f2i[f"T{t}_{s}"], rows]
+	return active
+
+def lead_values (num, den, lead_type, f2, const):
+	""" The leads of `lead_type` for arrays of num/den dot products; f2 broadcasts against them. """
 	if lead_type == "l1":
 		return num/den
 	elif lead_type == "l2":
-		return (f2 * (logsigmoid (num) - logsigmoid(den)))
+		return (f2 * (logsigmoid_array (num) - logsigmoid_array (den)))
 	elif lead_type == "l3":
-		return (f2 * (logsigmoid (num + const) - logsigmoid (den + const)))
+		return (f2 * (logsigmoid_array (num + const) - logsigmoid_array (den + const)))
 	elif lead_type == "l4":
-		return logsigmoid (num) - logsigmoid(den)
+		return logsigmoid_array (num) - logsigmoid_array (den)
 	elif lead_type == "l5":
-		return logsigmoid (num + const) - logsigmoid (den + const)	
-	
+		return logsigmoid_array (num + const) - logsigmoid_array (den + const)
+
+def score_leads (arrays, start, stop, variants=None, sources=None, n_times=None, const=None, block_size=1024):
+	""" {lead_type: (best dyads, leads)} of the candidates in [start, stop); a lead of -inf means no dyad. """
+	s1, s2 = [np.array (side, dtype=np.int64) for side in zip (*itertools.permutations (range (len (sources)), 2))]
+	times = np.arange (n_times - 1)
+	results = dict ()
+	for block_start in range (start, stop, block_size):
+		block = slice (block_start, min (block_start + block_size, stop))
+		size = block.stop - block.start
+		active, t1, t2 = arrays["active"][block], arrays["t1"][block], arrays["t2"][block]
+		valid = active[:, :-1, s1] & active[:, 1:, s2] & active[:, :-1, s2] & \
+				((times >= t1[:, np.newaxis]) & (times < t2[:, np.newaxis]))[:, :, np.newaxis]
+		for variant, types in variants:
+			conditional = {key[1]: array for key, array in arrays.items () if isinstance (key, tuple) and key[0] == variant}
+			tensor = get_word_tensors (arrays["rows"][block], conditional, sources, n_times)
+			# (W, T-1, S, S): every source at t against every source at t+1
+			dots = np.matmul (tensor[:, :-1], tensor[:, 1:].transpose (0, 1, 3, 2))
+			num = dots[:, :, s1, s2]
+			den = dots[:, :, s2, s2]
+			for lead_type in types:
+				with np.errstate (divide="ignore", invalid="ignore"):
+					leads = lead_values (num, den, lead_type, arrays["f2"][block, np.newaxis, np.newaxis], const)
+				leads = np.where (valid & ~np.isnan (leads), leads, -np.inf)
+				# dyads ordered by source pair first, then time, as they used to be enumerated
+				leads = leads.transpose (0, 2, 1).reshape (size, -1)
+				best = np.argmax (leads, axis=1)
+				if lead_type not in results:
+					results[lead_type] = (np.empty (stop - start, dtype=np.int64), np.empty (stop - start, dtype=leads.dtype))
+				results[lead_type][0][block.start - start:block.stop - start] = best
+				results[lead_type][1][block.start - start:block.stop - start] = leads[np.arange (size), best]
+	return results
+
+def get_leader_dyads (words, deviations, embeddings, normalized_embeddings, sources, w2i, lead_types, vocab_size=None, block_size=1024, workers=1):
+	""" {lead_type: {word: ((s1, s2, t, t+1), lead)}}, or (None, None) for words without a leading dyad. """
+	# w2i may only cover the candidate words, so prefer the size of the full vocabulary
+	V = len (w2i) if vocab_size is None else vocab_size
+	k = 50 # I would like to remove this hardcoded code
+	const = math.log (V/k) 
+
+	# the order of itertools.permutations (sources, 2), so that ties go to the same dyad
+	sources = list (sources)
+	pairs = list (itertools.permutations (sources, 2))
+	items = [(str(item[0]), int(item[1][1:]), int(item[2][1:]), item[3], item[4]) for item in words if str(item[0]) in w2i]
+	variants = [("unnormalized", embeddings, [lead_type for lead_type in lead_types if lead_type == "l1"]), \
+				("normalized", normalized_embeddings, [lead_type for lead_type in lead_types if lead_type != "l1"])]
+	variants = [(variant, conditional, types) for variant, conditional, types in variants if len (types) > 0]
+	n_times = max ([int (facet[0][1:]) + 1 for _, conditional, _ in variants for facet in conditional if isinstance (facet, tuple)] + \
+				   [t2 + 1 for _, _, t2, _, _ in items] + [2])
+
+	arrays = {"rows": np.array ([w2i[w] for w, _, _, _, _ in items], dtype=np.int64), \
+			  "t1": np.array ([t for _, t, _, _, _ in items], dtype=np.int64), \
+			  "t2": np.array ([t for _, _, t, _, _ in items], dtype=np.int64), \
+			  "f2": np.array ([f for _, _, _, _, f in items], dtype=np.float64), \
+			  "active": get_active_sources ([w for w, _, _, _, _ in items], deviations, sources, n_times)}
+	for variant, conditional, _ in variants:
+		for facet, mat in conditional.items ():
+			if isinstance (facet, tuple):
+				arrays[(variant, facet)] = mat
+		arrays[(variant, MAIN_FEAT)] = conditional[MAIN_FEAT]
+	options = {"variants": [(variant, types) for variant, _, types in variants], "sources": sources, \
+			   "n_times": n_times, "const": const, "block_size": block_size}
+
+	if workers <= 1 or len (items) == 0:
+		results = score_leads (arrays, 0, len (items), **options)
+	else:
+		results = dict ()
+		with SharedArrays (arrays) as shared, WorkerPool (workers) as pool:
+			for (start, stop), shard in pool.imap (score_leads, shared.specs, wordRanges (len (items), workers), **options):
+				for lead_type, (best, leads) in shard.items ():
+					if lead_type not in results:
+						results[lead_type] = (np.empty (len (items), dtype=np.int64), np.empty (len (items), dtype=leads.dtype))
+					results[lead_type][0][start:stop] = best
+					results[lead_type][1][start:stop] = leads
+
+	leads_by_type = {lead_type: dict () for lead_type in lead_types}
+	for lead_type, (best, leads) in results.items ():
+		for i, (w, _, _, _, _) in enumerate (items):
+			if leads[i] == -np.inf:
+				leads_by_type[lead_type][w] = (None, None)
+			else:
+				p, x = divmod (int (best[i]), n_times - 1)
+				leads_by_type[lead_type][w] = ((pairs[p][0], pairs[p][1], x, x + 1), leads[i])
+	return leads_by_type
+
 def get_leader_words (dictionary):
 	return [key for key in dictionary if not dictionary[key] == (None,None)]
 
 def writeToFile (filename, changes, sep=";"):
 	changes.to_csv (filename, sep=sep, header=True, index=False)	
 
-def add2df (changes, dyads, lead_type):
+def dyads2df (dyads, lead_type):
+	""" The words with a leading dyad as a frame keyed by word, with the Lead{n}_s1/_s2/_t/_t+1 and Lead{n} columns. """
+	name = {"l1": "Lead1", "l2": "Lead2", "l3": "Lead3", "l4": "Lead4", "l5": "Lead5"}[lead_type]
+	found = [(w, key, value) for w, (key, value) in dyads.items () if key is not None and value is not None]
+	return pd.DataFrame ({"word": [w for w, _, _ in found], \
+						  f"{name}_s1": [key[0] for _, key, _ in found], \
+						  f"{name}_s2": [key[1] for _, key, _ in found], \
+						  f"{name}_t": [f"T{key[2]}" for _, key, _ in found], \
+						  f"{name}_t+1": [f"T{key[3]}" for _, key, _ in found], \
+						  name: [value for _, _, value in found]})
+
+def add2df (changes, dyads, lead_types):
 	"""
-	dyads is a dictionary with word as the key.
+	dyads maps every lead type to a dictionary with word as the key;
+	only the words with a leading dyad for every lead type are kept.
 	"""
-	lead_types = {"l1": "Lead1", "l2": "Lead2", "l3": "Lead3", "l4": "Lead4", "l5": "Lead5"}
-
-	rows = list ()
-	header = changes.columns.values.tolist()
-	for index, row in changes.iterrows ():
-		w = str(row["word"])
-		if w in dyads:
-			new_row = [row[name] for name in header]
-			key, value = dyads[w]
-			if key is not None and value is not None:
-				s1,s2,x,y = key
-				lead = value
-				new_row.extend ([s1, s2, f"T{x}", f"T{y}", lead])
-				rows.append (new_row)
-
-	new_df = pd.DataFrame (rows, columns=header + [f"{lead_types[lead_type]}_s1", f"{lead_types[lead_type]}_s2", f"{lead_types[lead_type]}_t", f"{lead_types[lead_type]}_t+1", lead_types[lead_type]])
+	leads = None
+	for lead_type in lead_types:
+		frame = dyads2df (dyads[lead_type], lead_type)
+		leads = frame if leads is None else leads.merge (frame, on="word", how="inner")
+
+	# words are matched as strings, whatever type pandas read them as
+	keys = changes["word"].astype (str).rename ("_key")
+	new_df = changes.join (keys).merge (leads.rename (columns={"word": "_key"}), on="_key", how="inner").drop (columns="_key")
 	return new_df
 
 def main (args):
+	facets_file = os.path.join (args.src_path, args.feats_file)
+	facet_names = readFeats (facets_file)
+	logging.info (f"Read {len(facet_names)} facets from {facets_file}")
+
+	changes_file = os.path.join (args.temp_path, args.changes_file)
+	candidates = pd.read_csv (changes_file, sep=";")
+	all_words = candidates[["word", "Period1", "Period2", "Freq1", "Freq2"]].values.tolist()
+
+	# only the time and source facets and the candidate words are needed
 	embeddings_file = os.path.join (args.src_path, args.embeddings_file)
-	embeddings = readEmbeddings (embeddings_file)
+	embeddings = readEmbeddings (embeddings_file, \
+								 facets=[name for facet in facet_names for name in facet], \
+								 words={str (item[0]) for item in all_words}, \
+								 dtype=args.dtype)
 	static_embeddings = embeddings[MAIN_FEAT]
 	logging.info (f"Embeddings read from {embeddings_file}")
 
 	# vocabulary
 	w2i = {w:i for i,w in enumerate (static_embeddings)}
 	i2w = {i:w for i,w in enumerate (static_embeddings)}
-	vocab_size = len (w2i)
-	logging.info (f"Vocabulary mapping done, total words {len(w2i)}")
-	
-	facets_file = os.path.join (args.src_path, args.feats_file)
-	facet_names = readFeats (facets_file)
-	logging.info (f"Read {len(facet_names)} facets from {facets_file}")
+	vocab_size = embeddings.vocab_size
+	logging.info (f"Vocabulary mapping done, total words {vocab_size}, candidate words {len(w2i)}")
 
-	changes_file = os.path.join (args.temp_path, args.changes_file)
-	candidates = pd.read_csv (changes_file, sep=";")
-	all_words = candidates[["word", "Period1", "Period2", "Freq1", "Freq2"]].values.tolist()
 	sources = set ([facet[1].split("_")[1] for facet in facet_names if len (facet) > 1])
 
-	for lead_type in args.lead_types:
-		if lead_type != "l1":
-			conditional_embeddings = get_conditional_embeddings (embeddings, w2i, i2w, facet_names, apply_normalization=True)
-		else:
-			conditional_embeddings = get_conditional_embeddings (embeddings, w2i, i2w, facet_names)
-			
-		leader_dyads = get_leader_dyads (all_words, embeddings, conditional_embeddings, sources, w2i, lead_type) 
-		candidates = add2df (candidates, leader_dyads, lead_type)
-		logging.info (f"Leadership scores calculated for {len(leader_dyads)} for lead type {lead_type}")
+	# conditional embeddings for the candidate words only
+	w2i = candidate_vocab (all_words, w2i)
+	i2w = {i:w for w,i in w2i.items ()}
+
+	# every lead type from one pass over the words
+	conditional_embeddings, normalized_embeddings = get_lead_embeddings (embeddings, w2i, i2w, facet_names, args.lead_types, dtype=args.dtype)
+	leader_dyads = get_leader_dyads (all_words, embeddings, conditional_embeddings, normalized_embeddings, sources, w2i, args.lead_types, vocab_size=vocab_size, workers=args.workers)
+	candidates = add2df (candidates, leader_dyads, args.lead_types)
+	logging.info (f"Leadership scores calculated for {len(w2i)} candidate words for lead types {' '.join (args.lead_types)}")
 
 	# write to file
 	leaders_file = os.path.join (args.src_path, args.leaders_file)
@@ -3,27 +3,37 @@ import pandas as pd
 import os
 import sys
 import numpy as np
+import logging
+from concurrent.futures import ThreadPoolExecutor
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 
 if "../scripts" not in sys.path: sys.path.append ("../scripts")
 from helpful_functions import readEmbeddings, normalize, sigmoid, logsigmoid, MAIN_FEAT
+from embedding_store import DTYPES
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="Comparing per word leadership statistic with a randomized dataset")
-	parser.add_argument ("--rand-path", type=str, required=True, help="directory contains source conditional embeddings for randomized datasets")
+	parser.add_argument ("--rand-path", type=str, required=False, default=None, help="directory contains source conditional embeddings for randomized datasets")
+	parser.add_argument ("--rand-paths", type=str, nargs="+", required=False, default=None, help="many randomized run directories, scored into a single --matrix-file")
 	parser.add_argument ("--obs-path", type=str, required=True, help="directory that contains the source conditional embeddings for observed data")
 	parser.add_argument ("--embeddings-file", type=str, required=True, help="embeddings file")
 	parser.add_argument ("--feats-file", type=str, required=True, help="features file")
 	parser.add_argument ("--leaders-file", type=str, required=True, help="leaders file")
-	parser.add_argument ("--output-file", type=str, required=True, help="output file")
+	parser.add_argument ("--output-file", type=str, required=False, default=None, help="output file (in --rand-path)")
+	parser.add_argument ("--matrix-file", type=str, required=False, default=None, help="word x run matrix of random_lead1 values for --rand-paths")
+	parser.add_argument ("--dtype", type=str, required=False, default="float64", choices=DTYPES, help="precision of the embeddings (default: float64)")
 	args = parser.parse_args ()
+	if (args.rand_path is None) == (args.rand_paths is None):
+		parser.error ("give either --rand-path or --rand-paths")
+	if args.rand_path is not None and args.output_file is None:
+		parser.error ("--rand-path requires --output-file")
+	if args.rand_paths is not None and args.matrix_file is None:
+		parser.error ("--rand-paths requires --matrix-file")
 	return args
 
 def readDFAsDict (df, columns=["word", "s1", "s2", "t", "t+1", "Lead1"]):
-	words = dict ()
 	cols = columns[1:]
-	for i, row in df[columns].iterrows():
-		words[row["word"]] = [row[col] for col in cols]
-	return words
+	return dict (zip (df["word"], df[cols].values.tolist ()))
 
 def readFeats (filename):
 	facet_names = [(MAIN_FEAT,)]
@@ -35,23 +45,23 @@ def readFeats (filename):
 
 	return facet_names
 
-def transform_to_numpy (dict_embeddings, w2i, i2w, activated_facets, apply_normalization=False):
+def transform_to_numpy (dict_embeddings, w2i, i2w, activated_facets, apply_normalization=False, dtype=None):
 	if len(activated_facets) == 1 and MAIN_FEAT in activated_facets:
-		mat = np.array([dict_embeddings[MAIN_FEAT][w] for i, w in enumerate (w2i)])
+		mat = np.array([dict_embeddings[MAIN_FEAT][w] for i, w in enumerate (w2i)], dtype=dtype)
 	else:
 		activated_facets.insert (0, MAIN_FEAT)
 		mat = np.array ([np.sum([dict_embeddings[facet_name][w] \
                                  for facet_name in activated_facets], axis=0) \
-                         for i, w in enumerate (w2i)])
+                         for i, w in enumerate (w2i)], dtype=dtype)
 	if apply_normalization:
 		mat = normalize (mat)
 	return mat
 
-def get_conditional_embeddings (deviations, w2i, i2w, facet_names, apply_normalization=False):
+def get_conditional_embeddings (deviations, w2i, i2w, facet_names, apply_normalization=False, dtype=None):
 	# Calculate the true embeddings based on the deviations.
 	fully_conditional_embeddings = dict ()
 	for facet in facet_names:
-		mat = transform_to_numpy (deviations, w2i, i2w, list(facet), apply_normalization=apply_normalization)
+		mat = transform_to_numpy (deviations, w2i, i2w, list(facet), apply_normalization=apply_normalization, dtype=dtype)
 		if len (facet) == 1 and MAIN_FEAT in facet:
 			fully_conditional_embeddings[MAIN_FEAT] = mat
 		else:
@@ -71,14 +81,13 @@ def lead_measurement (deviations, embeddings, w, s1, s2, t1, t2, w2i, lead_type)
 	# a source-specific deviation at the given times.
 	#if w not in deviations:
 	#   return 1 # This shouldn't really happen but I will debug this later.
-	if w not in deviations[f"T{t1}_{s1}"] or \
-	   w not in deviations[f"T{t2}_{s2}"] or \
-	   w not in deviations[f"T{t1}_{s2}"]:
+	# (see EmbeddingStore.activity, computed once for all words)
+	facets = [deviations.f2i[f"T{t1}_{s1}"], deviations.f2i[f"T{t2}_{s2}"], deviations.f2i[f"T{t1}_{s2}"]]
+	row = deviations.w2i.get (w)
+	if row is None or not deviations.mask[facets, row].all ():
 		return -1 # word not present
     
-	elif np.linalg.norm (deviations[f"T{t1}_{s1}"][w]) == 0 or \
-		 np.linalg.norm (deviations[f"T{t2}_{s2}"][w]) == 0 or \
-		 np.linalg.norm (deviations[f"T{t1}_{s2}"][w]) == 0:
+	elif not deviations.activity[facets, row].all ():
 		return -np.inf
 
 	e1 = embeddings[(f"T{t1}",s1)][w2i[w]]
@@ -91,32 +100,78 @@ def lead_measurement (deviations, embeddings, w, s1, s2, t1, t2, w2i, lead_type)
 	if lead_type == "l1":
 		return num/den
 
+def needed_facets (facet_names, observed_dict):
+	""" The facets lead_measurement reads for the observed dyads: MAIN, and T{t} and T{t}_{s} for the times and sources of every dyad. """
+	needed = set ()
+	for _, s1, s2, t1, t2, _ in observed_dict.values ():
+		t1, t2 = int (t1[1:]), int (t2[1:])
+		needed.update ([f"T{t1}_{s1}", f"T{t2}_{s2}", f"T{t1}_{s2}"])
+	return [facet for facet in facet_names if len (facet) == 1 or facet[1] in needed]
+
+def load_run (rand_path, observed_dict, feats_file, embeddings_file, dtype=None):
+	""" The embeddings and conditional embeddings of a randomized run, for the observed words and the facets of their dyads only. """
+	facet_names = needed_facets (readFeats (os.path.join (rand_path, feats_file)), observed_dict)
+	# a single parser, so that a text dump is never parsed by a pool forked from the prefetch thread
+	embeddings = readEmbeddings (os.path.join (rand_path, embeddings_file), \
+								 workers=1, \
+								 facets=[name for facet in facet_names for name in facet], \
+								 words=set (observed_dict), \
+								 dtype=dtype)
+	static_embeddings = embeddings[MAIN_FEAT]
+
+	# vocabulary
+	w2i = {w:i for i,w in enumerate (static_embeddings)}
+	i2w = {i:w for i,w in enumerate (static_embeddings)}
+    
+	conditional_embeddings = get_conditional_embeddings (embeddings, w2i, i2w, facet_names, dtype=dtype)
+	return embeddings, conditional_embeddings, w2i
+
+def score_run (observed_dict, embeddings, conditional_embeddings, w2i):
+	return {w: get_lead_score (w, embeddings, conditional_embeddings, observed_dict[w], w2i, "l1") for w in observed_dict}
+
+def score_runs (rand_paths, observed_dict, feats_file, embeddings_file, dtype=None):
+	""" {run: {word: random_lead1}} for many runs; the next run is loaded in the background while the current one is scored. """
+	leads = dict ()
+	with ThreadPoolExecutor (max_workers=1) as loader:
+		future = loader.submit (load_run, rand_paths[0], observed_dict, feats_file, embeddings_file, dtype)
+		for i, rand_path in enumerate (rand_paths):
+			run = future.result ()
+			if i + 1 < len (rand_paths):
+				future = loader.submit (load_run, rand_paths[i+1], observed_dict, feats_file, embeddings_file, dtype)
+			leads[rand_path] = score_run (observed_dict, *run)
+			logging.info (f"Scored run {i+1}/{len (rand_paths)}: {rand_path}")
+	return leads
+
+def write_matrix (filename, observed_dict, leads):
+	""" One row per observed word (in rank order) and one random_lead1 column per run. """
+	runs = list (leads)
+	with open (filename, "w") as fout:
+		header = ",".join (["word", "rank"] + [os.path.basename (os.path.normpath (run)) for run in runs])
+		fout.write (f"{header}\n")
+		for key, value in sorted (observed_dict.items(), key=lambda x:x[1][0], reverse=False):
+			text = ",".join ([f"{key}", f"{value[0]}"] + [f"{leads[run][key]:.4f}" for run in runs])
+			fout.write (f"{text}\n")
+
 def main (args):
-	# load the observed leadership data
+	# load the observed leadership data (once, for every run)
 	observed_df = pd.read_csv (os.path.join (args.obs_path, args.leaders_file), sep=";")	
 	
 	# Select word, s1, s2, t, t+1, lead1
 	observed_dict = readDFAsDict(observed_df, columns=["word", "rank", "s1", "s2", "t", "t+1", "Lead1"])
 
-	# Now go over the randomization run
-	embeddings_file = os.path.join (args.rand_path, args.embeddings_file)
-	embeddings = readEmbeddings (embeddings_file)
-	static_embeddings = embeddings[MAIN_FEAT]
+	if args.rand_paths is not None:
+		leads = score_runs (args.rand_paths, observed_dict, args.feats_file, args.embeddings_file, dtype=args.dtype)
+		write_matrix (args.matrix_file, observed_dict, leads)
+		logging.info (f"Matrix of {len (observed_dict)} words x {len (leads)} runs written to {args.matrix_file}")
+		return
 
-	# vocabulary
-	w2i = {w:i for i,w in enumerate (static_embeddings)}
-	i2w = {i:w for i,w in enumerate (static_embeddings)}
-	vocab_size = len (w2i)
-
-	facets_file = os.path.join (args.rand_path, args.feats_file)
-	facet_names = readFeats (facets_file)
-    
-	conditional_embeddings = get_conditional_embeddings (embeddings, w2i, i2w, facet_names)
+	# Now go over the randomization run, reading only the source facets for the observed words
+	embeddings, conditional_embeddings, w2i = load_run (args.rand_path, observed_dict, args.feats_file, args.embeddings_file, dtype=args.dtype)
+	leads = score_run (observed_dict, embeddings, conditional_embeddings, w2i)
 
 	randomized_dict = dict ()
 	for w in observed_dict:
-		lead = get_lead_score (w, embeddings, conditional_embeddings, observed_dict[w], w2i, "l1")
-		randomized_dict[w] = observed_dict[w] + [lead]
+		randomized_dict[w] = observed_dict[w] + [leads[w]]
 
 	# write to file
 	with open (os.path.join (args.rand_path, args.output_file), "w") as fout:
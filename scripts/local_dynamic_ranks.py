@@ -4,12 +4,18 @@ python local_dynamic_ranks.py --dir-path ../data/aa_temp.1 --embeddings-file out
 
 import argparse
 import numpy as np
-from collections import defaultdict
-import pickle
 import os
 import itertools
-import pandas as pd
+import contextlib
+import hashlib
+import heapq
+import csv
+import logging
 from helpful_functions import readEmbeddings, normalize
+from embedding_store import DTYPES
+from neighbor_store import NeighborStore, hasNeighbors, convertPickles
+from shared_arrays import SharedArrays, WorkerPool, wordRanges
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="Top changed words")
@@ -17,10 +23,15 @@ def readArgs ():
 	parser.add_argument ("--embeddings-file", required=True, type=str, help="filename of the embeddings")
 	parser.add_argument ("--k", required=False, type=int, default=10, help="number of near neighbors to be used (default: 10)")
 	parser.add_argument ("--scores-file", required=True, type=str, help="file contains the ranked list of words based on quantity of semantic change")
+	parser.add_argument ("--dtype", required=False, type=str, default="float64", choices=DTYPES, help="precision of the embeddings (default: float64)")
+	parser.add_argument ("--workers", required=False, type=int, default=1, help="processes scoring ranges of words (default: 1)")
+	parser.add_argument ("--top-n", required=False, type=int, default=None, help="only write the top N words of the ranking (default: all)")
+	parser.add_argument ("--recompute", required=False, action="store_true", help="rescore every facet pair instead of reusing the unchanged ones from {scores-file}.pairs/")
+	parser.add_argument ("--no-cache", required=False, action="store_true", help="neither read nor write the per-pair distances")
 	args = parser.parse_args ()
 	return args
 
-def emds2temporal (embeddings, facet_names):
+def emds2temporal (embeddings, facet_names, dtype=None, shared=None):
 	# Separate the main embeddings and the facet embeddings
 	static_embeddings = embeddings["MAIN"]
 	
@@ -29,86 +40,205 @@ def emds2temporal (embeddings, facet_names):
 	i2w = {i:w for i, w in enumerate (static_embeddings)}
 
 	# the atemporal embeddings
-	main_embeddings = np.array([static_embeddings[i2w[i]] for i in range (len(i2w))])
+	main_embeddings = np.array([static_embeddings[i2w[i]] for i in range (len(i2w))], dtype=dtype)
 	main_embeddings = normalize (main_embeddings)
 	
 	residual_embeddings = {facet_name: embeddings[facet_name] for facet_name in facet_names}
-	temporal_embeddings = {facet_name: normalize(np.array([static_embeddings[i2w[i]] + residual_embeddings[facet_name][i2w[i]] for i in range (len(i2w))])) for facet_name in facet_names}
+	temporal_embeddings = dict ()
+	for facet_name in facet_names:
+		matrix = normalize(np.array([static_embeddings[i2w[i]] + residual_embeddings[facet_name][i2w[i]] for i in range (len(i2w))], dtype=dtype))
+		# with workers, each matrix lives only in shared memory (see getScores)
+		temporal_embeddings[facet_name] = matrix if shared is None else shared.add ((facet_name, "embeddings"), matrix)
 
 
 	return main_embeddings, temporal_embeddings, (w2i, i2w)
 
-def readNeighbors (files):
-	neighbors = dict ()
-	for filename in files:
-		basename = os.path.basename (filename)
-		facet = basename.split (".")[0]
-		with open (filename, "rb") as fin:
-			neighbor = pickle.load (fin)
-			neighbors[facet] = neighbor
-	
-	return neighbors
+def readNeighbors (dir_path, facet_names):
+	# neighbors written as pickles (near_neighbors.py --facet-name) are converted
+	# once, and again whenever a pickle is rewritten
+	stale = [facet for facet in facet_names if not hasNeighbors (dir_path, [facet])]
+	if len (stale) > 0:
+		convertPickles (dir_path, stale)
+	return NeighborStore (dir_path)
 
 def cos_dist (vec1, vec2):
-	l1 = np.linalg.norm (vec1)
-	l2 = np.linalg.norm (vec2)
+	""" Cosine distance between the rows of two (n, m) arrays. """
+	l1 = np.sqrt (np.einsum ("ij,ij->i", vec1, vec1))
+	l2 = np.sqrt (np.einsum ("ij,ij->i", vec2, vec2))
 
-	sim = (np.dot (vec1, vec2)/(l1*l2))
+	with np.errstate (divide="ignore", invalid="ignore"):
+		sim = (np.einsum ("ij,ij->i", vec1, vec2)/(l1*l2))
 	return 1-sim	
 
-def getScores (embeddings, neighbors, voc, k=10):
-	scores = defaultdict (list)
+def neighborMatrix (neighbors, facet, voc, k=10):
+	""" (V, k) rows of the first k embedded neighbors of every word of `voc` in `facet`, -1 past the last one (or for words without any). """
 	w2i, i2w = voc
-	facets = [key for key in embeddings]
-	for word in w2i:
-		for f1, f2 in itertools.combinations (facets, 2):
-			neighbors1 = neighbors[f1][word][0]
-			neighbors2 = neighbors[f2][word][0]
-			s1, n1 = {n:s for s,n in neighbors1}, [n for _,n in neighbors1]
-			s2, n2 = {n:s for s,n in neighbors2}, [n for _,n in neighbors2]
-			common = set (n1[0:k]).union (n2[0:k])
-			s1_vec = [np.dot (embeddings[f1][w2i[word]], embeddings[f1][w2i[n]]) for n in common]
-			s2_vec = [np.dot (embeddings[f2][w2i[word]], embeddings[f2][w2i[n]]) for n in common]
-			dist = cos_dist (s1_vec, s2_vec)
-			scores[word].append ((f1, f2, dist))
-			
+	indices, _ = neighbors.arrays (facet)
+	# the store and the embeddings may order their vocabularies differently
+	# the trailing -1 maps the -1 padding onto itself
+	to_rows = np.array ([w2i.get (w, -1) for w in neighbors.vocab] + [-1])
+	from_rows = np.array ([neighbors.w2i.get (i2w[i], -1) for i in range (len (i2w))], dtype=np.int64)
+	found = from_rows >= 0
+	if not found.all ():
+		logging.warning (f"{int ((~found).sum ())} words have no neighbors in {facet}")
+	matrix = np.full ((len (i2w), indices[:, :k].shape[1]), -1, dtype=to_rows.dtype)
+	matrix[found] = to_rows[np.asarray (indices[from_rows[found], :k])]
+	return matrix
+
+def neighborUnion (n1, n2):
+	""" The union of the neighbors in each row of n1 and n2, padded: (rows with pads set to 0, validity mask). """
+	union = np.sort (np.concatenate ([n1, n2], axis=1), axis=1)
+	valid = union >= 0
+	valid[:, 1:] &= union[:, 1:] != union[:, :-1]
+	return np.where (valid, union, 0), valid
+
+def scoreRows (arrays, start, stop, pairs=None, block_size=4096):
+	""" The (stop - start, pairs) scores of the words in rows [start, stop), from the
+		(facet, "embeddings") and (facet, "neighbors") arrays of every facet.
+	"""
+	scores = np.empty ((stop - start, len (pairs)))
+	for p, (f1, f2) in enumerate (pairs):
+		e1, e2 = arrays[(f1, "embeddings")], arrays[(f2, "embeddings")]
+		for block_start in range (start, stop, block_size):
+			rows = np.arange (block_start, min (block_start + block_size, stop))
+			common, valid = neighborUnion (arrays[(f1, "neighbors")][rows], arrays[(f2, "neighbors")][rows])
+			s1_vec = np.einsum ("id,ijd->ij", e1[rows], e1[common]) * valid
+			s2_vec = np.einsum ("id,ijd->ij", e2[rows], e2[common]) * valid
+			scores[rows - start, p] = cos_dist (s1_vec, s2_vec)
 	return scores
 
-def getMaximalScores (scores, ignore="MAIN"):
-	maximal = dict ()
-	for w in scores:
-		score = [item for item in scores[w] if not item[0] == ignore and not item[1] == ignore]
-		maximal[w] = max (score, key=lambda x:x[2])
-	return maximal
-
-def getRankedList (maximal_scores):
-	ranks = {word: i for i, (word, item) in enumerate (sorted (maximal_scores.items(), key=lambda x:x[1][2], reverse=True))}
-	return ranks
-
-def writeResults (scores, ranks, neighbors, filename, k=10, sep=";"):	
-	items = list ()
-	for word, rank in sorted (ranks.items(), key=lambda x:x[1]):
-		p1, p2, score = scores[word]
-		n1 = [n for _,n in neighbors[p1][word][0][0:k]]
-		n2 = [n for _,n in neighbors[p2][word][0][0:k]]
-
-		items.append ([word, rank, p1, p2, n1, n2, score])
+def getScores (embeddings, neighbors, voc, k=10, block_size=4096, workers=1, pairs=None, matrices=None, shared=None):
+	""" The facet pairs (all by default) and the (V, pairs) cosine distances between the similarities of every word to the union of its k neighbors in both facets. """
+	w2i, i2w = voc
+	pairs = list (itertools.combinations ([key for key in embeddings], 2)) if pairs is None else pairs
+	facets = sorted ({facet for pair in pairs for facet in pair})
+	matrices = dict () if matrices is None else matrices
+	arrays = dict ()
+	for facet in facets:
+		arrays[(facet, "embeddings")] = embeddings[facet]
+		arrays[(facet, "neighbors")] = matrices[facet] if facet in matrices else neighborMatrix (neighbors, facet, voc, k=k)
+	if workers <= 1:
+		return pairs, scoreRows (arrays, 0, len (i2w), pairs=pairs, block_size=block_size)
+
+	scores = np.empty ((len (i2w), len (pairs)))
+	with (SharedArrays () if shared is None else contextlib.nullcontext (shared)) as shared, WorkerPool (workers) as pool:
+		for key, array in arrays.items ():
+			if key not in shared.specs:
+				shared.add (key, array)
+		specs = {key: shared.specs[key] for key in arrays}
+		for (start, stop), partial in pool.imap (scoreRows, specs, wordRanges (len (i2w), workers), pairs=pairs, block_size=block_size):
+			scores[start:stop] = partial
+			
+	return pairs, scores
 
-	df = pd.DataFrame (items, columns=["word", "rank", "Period1", "Period2", "Neighbors1", "Neighbors2", "Score"])
-	df.to_csv (filename, sep=sep, header=True, index=False)
+def facetHash (embedding, matrix, voc, k):
+	""" Content hash of everything the scores of a facet depend on. """
+	w2i, i2w = voc
+	digest = hashlib.sha1 ()
+	digest.update ("\n".join (i2w[i] for i in range (len (i2w))).encode ("utf-8"))
+	digest.update (f"{k}\t{embedding.dtype.str}".encode ("utf-8"))
+	digest.update (np.ascontiguousarray (embedding))
+	digest.update (np.ascontiguousarray (matrix))
+	return digest.hexdigest ()
+
+def readHashes (filename):
+	hashes = dict ()
+	if os.path.exists (filename):
+		with open (filename) as fin:
+			for line in fin:
+				facet, digest = line.rstrip ("\n").split ("\t")
+				hashes[facet] = digest
+	return hashes
+
+def cachedScores (embeddings, neighbors, voc, cache_path, k=10, workers=1, recompute=False, shared=None):
+	""" getScores, reusing the {f1}.{f2}.npy distances in `cache_path` of the pairs whose facets kept their facetHash. """
+	facets = [key for key in embeddings]
+	pairs = list (itertools.combinations (facets, 2))
+	matrices = {facet: neighborMatrix (neighbors, facet, voc, k=k) for facet in facets}
+	hashes = {facet: facetHash (embeddings[facet], matrices[facet], voc, k) for facet in facets}
+	hashes_file = os.path.join (cache_path, "facets.hashes")
+	cached = dict () if recompute else readHashes (hashes_file)
+
+	scores = np.empty ((len (voc[1]), len (pairs)))
+	todo = list ()
+	for p, (f1, f2) in enumerate (pairs):
+		pair_file = os.path.join (cache_path, f"{f1}.{f2}.npy")
+		if cached.get (f1) == hashes[f1] and cached.get (f2) == hashes[f2] and os.path.exists (pair_file):
+			scores[:, p] = np.load (pair_file)
+		else:
+			todo.append (p)
+	logging.info (f"Reusing {len (pairs) - len (todo)} of {len (pairs)} facet pairs, scoring {len (todo)}")
+	if len (todo) == 0:
+		return pairs, scores
+
+	_, new_scores = getScores (embeddings, neighbors, voc, k=k, workers=workers, pairs=[pairs[p] for p in todo], matrices=matrices, shared=shared)
+	scores[:, todo] = new_scores
+	os.makedirs (cache_path, exist_ok=True)
+	# no hashes while the arrays are rewritten, so an interrupted run never pairs old hashes with new arrays
+	if os.path.exists (hashes_file):
+		os.remove (hashes_file)
+	for j, p in enumerate (todo):
+		f1, f2 = pairs[p]
+		np.save (os.path.join (cache_path, f"{f1}.{f2}.npy"), new_scores[:, j])
+	with open (hashes_file, "w") as fout:
+		for facet in facets:
+			fout.write (f"{facet}\t{hashes[facet]}\n")
+	return pairs, scores
+
+def getMaximalScores (pairs, scores, ignore="MAIN"):
+	""" The first pair with the largest change of every word and that change, ignoring the pairs with `ignore`. """
+	kept = np.array ([p for p, (f1, f2) in enumerate (pairs) if not f1 == ignore and not f2 == ignore])
+	best = kept[np.argmax (scores[:, kept], axis=1)]
+	return best, scores[np.arange (len (scores)), best]
+
+def getRankedList (maximal_scores, top_n=None):
+	""" Word rows from the largest to the smallest change (only the first top_n with `top_n`); ties keep the vocabulary order. """
+	if top_n is None:
+		return np.argsort (-maximal_scores, kind="stable")
+	# NaN (no neighbors at all) ranks last, as in the full sort
+	keys = np.where (np.isnan (maximal_scores), -np.inf, maximal_scores).tolist ()
+	return np.array (heapq.nlargest (top_n, range (len (keys)), key=lambda i: (keys[i], -i)), dtype=np.int64)
+
+def formatScore (score):
+	""" A score as pandas.DataFrame.to_csv writes it. """
+	return "" if np.isnan (score) else repr (float (score))
+
+def writeResults (pairs, best, maximal_scores, order, neighbors, voc, filename, k=10, sep=";"):	
+	""" Stream the ranked words to `filename`, one row at a time, in the format of pandas.DataFrame.to_csv. """
+	w2i, i2w = voc
+	with open (filename, "w", newline="") as fout:
+		writer = csv.writer (fout, delimiter=sep, lineterminator="\n")
+		writer.writerow (["word", "rank", "Period1", "Period2", "Neighbors1", "Neighbors2", "Score"])
+		for rank, i in enumerate (order):
+			word = i2w[i]
+			p1, p2 = pairs[best[i]]
+			n1 = [n for _,n in neighbors.neighbors (p1, word, k)]
+			n2 = [n for _,n in neighbors.neighbors (p2, word, k)]
+
+			writer.writerow ([word, rank, p1, p2, n1, n2, formatScore (maximal_scores[i])])
+
+def facetScores (args, embeddings, facet_names, shared=None):
+	""" The facet pairs, their (V, pairs) scores, the vocabulary and the neighbors of the temporal facets. """
+	main_embeddings, temporal_embeddings, voc = emds2temporal(embeddings, facet_names, dtype=args.dtype, shared=shared)
+
+	neighbors = readNeighbors (args.dir_path, facet_names)
+	if args.no_cache:
+		pairs, scores = getScores (temporal_embeddings, neighbors, voc, k=args.k, workers=args.workers, shared=shared)
+	else:
+		cache_path = os.path.join (args.dir_path, f"{args.scores_file}.pairs")
+		pairs, scores = cachedScores (temporal_embeddings, neighbors, voc, cache_path, k=args.k, workers=args.workers, recompute=args.recompute, shared=shared)
+	return pairs, scores, voc, neighbors
 
 def main (args):	
-	embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file))
+	embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file), dtype=args.dtype)
 	facet_names = [key for key in embeddings if not key == "MAIN"]
-	main_embeddings, temporal_embeddings, voc = emds2temporal(embeddings, facet_names)
-	
-	w2i, i2w = voc
 
-	neighbors = readNeighbors ([os.path.join (args.dir_path, f"{facet_name}.neighbors.pkl") for facet_name in facet_names])
-	scores = getScores (temporal_embeddings, neighbors, voc, k=args.k)
-	maximal_scores = getMaximalScores (scores)
-	ranks = getRankedList (maximal_scores)
-	writeResults (maximal_scores, ranks, neighbors, os.path.join (args.dir_path, args.scores_file), k=10, sep=";")
+	# the temporal embeddings are released (with the shared memory) once they are scored
+	with (SharedArrays () if args.workers > 1 else contextlib.nullcontext ()) as shared:
+		pairs, scores, voc, neighbors = facetScores (args, embeddings, facet_names, shared=shared)
+	best, maximal_scores = getMaximalScores (pairs, scores)
+	order = getRankedList (maximal_scores, top_n=args.top_n)
+	writeResults (pairs, best, maximal_scores, order, neighbors, voc, os.path.join (args.dir_path, args.scores_file), k=10, sep=";")
 
 if __name__ == "__main__":
 	main (readArgs())
@@ -12,10 +12,10 @@ sys     0m4.873s
 import argparse
 import os
 import datetime
-import re
 import ujson
-from collections import defaultdict
+from collections import Counter
 from helpful_functions import safe_open_w
+from tokenizer import tokenize_batch
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="")
@@ -29,12 +29,6 @@ def readArgs ():
 	args = parser.parse_args ()
 	return args
 
-def is_valid_word (word):
-	""" accepts a word only if contains all alphabetic characters 
-		or hyphen """
-	word = word.strip()
-	return re.match(r'^[a-zA-Z][A-Za-z-]*$', word)
-
 def timestamp2epoch (timestamp, stride):
 	nEpochs = int(1/stride)
 	ranges = [(i*stride, (i+1) * stride) for i in range (nEpochs)]
@@ -81,7 +75,7 @@ class Reader (object):
 						if filename.endswith (self.file_ext):
 							yield os.path.join (dir_path, filename), source, date
 
-	def transfer (self, format="%Y%m%d", mode="source", verbose=False):
+	def transfer (self, format="%Y%m%d", mode="source", verbose=False, batch_size=1000):
 		# Read all the documents in memory.
 		documents = [(filename, source, datetime.datetime.strptime(date, date_format (date, format))) for filename, source, date in self._walk (verbose=verbose)]
 		excluded_files = set ()
@@ -116,27 +110,30 @@ class Reader (object):
 			ordered_collection = documents
 
 		records = 0
-		self.vocab = defaultdict (int)
+		self.vocab = Counter ()
 		with safe_open_w (self.to_file) as fout:
-			for filename, source, date in ordered_collection:
-				t = date.timestamp ()
-				timestamp = (t - min_time)/(max_time-min_time)
-				with open (filename) as fin:
-					js = ujson.loads (fin.read().strip())
-					text = js["corrected_text"]
-					tokens = [token.lower() for token in text.split () if is_valid_word (token)]
+			for start in range (0, len (ordered_collection), batch_size):
+				batch = ordered_collection[start:start + batch_size]
+				texts = list ()
+				for filename, _, _ in batch:
+					with open (filename) as fin:
+						js = ujson.loads (fin.read().strip())
+						texts.append (js["corrected_text"])
+
+				for (filename, source, date), tokens in zip (batch, tokenize_batch (texts)):
 					if len (tokens) == 0:
 						continue
-					for token in tokens:
-						self.vocab[token] += 1
+					self.vocab.update (tokens)
 					tokenized_text = " ".join(tokens)
-				bin_name=f"T{timestamp2epoch (timestamp, stride)}"
-				source_name = f"{bin_name}_{source}"
-				if mode == "source":
-					fout.write ("\t".join ([filename, bin_name, source_name, tokenized_text]) + "\n")
-				else:
-					fout.write ("\t".join ([filename, bin_name, bin_name, tokenized_text]) + "\n")	
-				records += 1
+					t = date.timestamp ()
+					timestamp = (t - min_time)/(max_time-min_time)
+					bin_name=f"T{timestamp2epoch (timestamp, stride)}"
+					source_name = f"{bin_name}_{source}"
+					if mode == "source":
+						fout.write ("\t".join ([filename, bin_name, source_name, tokenized_text]) + "\n")
+					else:
+						fout.write ("\t".join ([filename, bin_name, bin_name, tokenized_text]) + "\n")	
+					records += 1
 
 		if verbose:
 			print (f"{self.to_file} contains {records} records")
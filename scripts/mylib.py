@@ -1,4 +1,5 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 def semantic_neighbors(word:str, embs:np.array, voc:tuple, k=3) -> list:
 	""" Get the list of near neighbors for a given word from the embeddings.
@@ -17,3 +18,49 @@ def semantic_neighbors(word:str, embs:np.array, voc:tuple, k=3) -> list:
 			output.append((sims[sim_idx], i2w[sim_idx]))
 	return output
 
+
+def _top_neighbors_block(embs:np.array, start:int, stop:int, k:int) -> tuple:
+	sims = np.dot(embs[start:stop], embs.T)
+	n = min(k + 1, sims.shape[1])
+	candidates = np.argpartition(-sims, n - 1, axis=1)[:, :n]
+	candidate_sims = np.take_along_axis(sims, candidates, axis=1)
+	# descending similarity (ties by descending index, as argsort()[::-1] gives),
+	# then drop the first entry, which is the word itself
+	order = np.lexsort((-candidates, -candidate_sims), axis=1)[:, 1:]
+	indices = np.take_along_axis(candidates, order, axis=1)
+	values = np.take_along_axis(candidate_sims, order, axis=1)
+	indices[~(values > 0)] = -1
+	return indices, values
+
+def semantic_neighbors_batch(embs:np.array, k=3, start=0, stop=None, block_size=1024, threads=1, max_scores=50000000) -> tuple:
+	""" Near neighbors of the words in rows [start, stop) of `embs`, computed blockwise.
+
+		Each block of rows is multiplied against the whole matrix and the top k
+		are picked with argpartition; blocks run on `threads` threads.
+		The blocks are cut so that all the threads hold at most `max_scores`
+		similarities at once (each similarity costs about 24 bytes).
+		Returns (indices, sims), both of shape (stop - start, k): row i holds
+		what semantic_neighbors returns for word start + i, padded with index
+		-1 where there are fewer than k neighbors with a positive similarity.
+
+		NOTE: Assumes that the embeddings are unit vectors.
+	"""
+	stop = embs.shape[0] if stop is None else stop
+	k = min(k, max(embs.shape[0] - 1, 0))
+	indices = np.full((stop - start, k), -1, dtype=np.int32)
+	sims = np.zeros((stop - start, k), dtype=embs.dtype)
+	block_size = max(1, min(block_size, max_scores // (threads * max(embs.shape[0], 1))))
+
+	def run(block_start):
+		block_stop = min(block_start + block_size, stop)
+		block_indices, block_sims = _top_neighbors_block(embs, block_start, block_stop, k)
+		indices[block_start - start:block_stop - start] = block_indices
+		sims[block_start - start:block_stop - start] = block_sims
+
+	if threads == 1:
+		for block_start in range(start, stop, block_size):
+			run(block_start)
+	else:
+		with ThreadPoolExecutor(max_workers=threads) as pool:
+			list(pool.map(run, range(start, stop, block_size)))
+	return indices, sims
@@ -70,7 +70,7 @@ def generate_annotations (filename, w2i):
 	return annotations, neg_annotations
 
 def main (args):
-	embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file))
+	embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file), facets=["MAIN"])
 	static_embeddings = embeddings["MAIN"]
 
 	w2i = {w:i for i,w in enumerate (static_embeddings)}
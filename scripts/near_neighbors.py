@@ -1,35 +1,96 @@
 import argparse
 import os
+import contextlib
 import numpy as np
 import logging
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 from collections import defaultdict
 import pickle
 from helpful_functions import readEmbeddings, normalize
-from mylib import semantic_neighbors
+from embedding_store import frequentWords, DTYPES
+from mylib import semantic_neighbors_batch
+from neighbor_store import writeVocab, writeNeighbors
+from shared_arrays import SharedArrays, WorkerPool, wordRanges
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="Near negihbors for words")
 	parser.add_argument ("--dir-path", required=True, type=str, help="directory path")
 	parser.add_argument ("--embeddings-file", required=True, type=str, help="embeddings file")
-	parser.add_argument ("--near-neighbors-file", required=True, type=str, help="near neighbors file")
+	parser.add_argument ("--near-neighbors-file", required=False, type=str, default=None, help="near neighbors file (pickle, for a single --facet-name)")
+	parser.add_argument ("--all-facets", required=False, action="store_true", help="neighbors for MAIN and every other facet, written as arrays (see neighbor_store.py)")
 	parser.add_argument ("--facet-name", required=False, type=str, default="MAIN", help="name of the facet (default: MAIN)")
 	parser.add_argument ("--nearest", required=False, type=int, default=25, help="number of near neighbors (default: 25)")
+	parser.add_argument ("--vocab-file", required=False, type=str, default=None, help="count<TAB>word vocabulary file, used with --min-count")
+	parser.add_argument ("--min-count", required=False, type=int, default=None, help="only keep words with at least this count in --vocab-file")
+	parser.add_argument ("--dtype", required=False, type=str, default="float64", choices=DTYPES, help="precision of the embeddings (default: float64)")
+	parser.add_argument ("--block-size", required=False, type=int, default=1024, help="number of words multiplied against the vocabulary at once (default: 1024)")
+	parser.add_argument ("--threads", required=False, type=int, default=1, help="threads working on blocks; pin the BLAS threads (e.g. OMP_NUM_THREADS=1) when using several (default: 1)")
+	parser.add_argument ("--max-scores", required=False, type=int, default=50000000, help="bound on the similarities held at once by all the threads of a process, about 24 bytes each (default: 5e7)")
+	parser.add_argument ("--workers", required=False, type=int, default=1, help="processes working on ranges of words over shared memory, each with one thread (default: 1)")
 	args = parser.parse_args ()
+	if args.min_count is not None and args.vocab_file is None:
+		parser.error ("--min-count requires --vocab-file")
+	if not args.all_facets and args.near_neighbors_file is None:
+		parser.error ("--near-neighbors-file is required without --all-facets")
 	return args
 
-def getNeighbors (all_embeddings, w2i, i2w, k=25, log_every=1000):
+def neighborRows (arrays, start, stop, k=25, block_size=1024, max_scores=50000000):
+	return semantic_neighbors_batch (arrays["embeddings"], k=k, start=start, stop=stop, block_size=block_size, threads=1, max_scores=max_scores)
+
+def computeNeighbors (embs, k=25, block_size=1024, threads=1, pool=None, workers=1, max_scores=50000000):
+	""" semantic_neighbors_batch over all the rows of `embs`; with a pool, the rows are
+		split between its processes and `embs` is shared with them (see shared_arrays.py).
+	"""
+	if pool is None:
+		return semantic_neighbors_batch (embs, k=k, block_size=block_size, threads=threads, max_scores=max_scores)
+
+	indices, sims = None, None
+	with SharedArrays ({"embeddings": embs}) as shared:
+		for (start, stop), (block_indices, block_sims) in pool.imap (neighborRows, shared.specs, wordRanges (len (embs), workers), k=k, block_size=block_size, max_scores=max_scores):
+			if indices is None:
+				indices = np.empty ((len (embs), block_indices.shape[1]), dtype=block_indices.dtype)
+				sims = np.empty ((len (embs), block_sims.shape[1]), dtype=block_sims.dtype)
+			indices[start:stop] = block_indices
+			sims[start:stop] = block_sims
+	return indices, sims
+
+def getNeighbors (all_embeddings, w2i, i2w, k=25, log_every=1000, block_size=1024, threads=1, pool=None, workers=1, max_scores=50000000):
 	neighbors = defaultdict (list)
-	for index, w in enumerate (w2i):
-		for i in range (len (all_embeddings)):
-			neighbors[w].append (semantic_neighbors (w, all_embeddings[i], (w2i, i2w), k=k))
+	for i in range (len (all_embeddings)):
+		# blocks of rows against the whole matrix (see mylib.semantic_neighbors_batch)
+		indices, sims = computeNeighbors (all_embeddings[i], k=k, block_size=block_size, threads=threads, pool=pool, workers=workers, max_scores=max_scores)
+		for index, w in enumerate (w2i):
+			row = w2i[w]
+			neighbors[w].append ([(sims[row, j], i2w[n]) for j, n in enumerate (indices[row]) if n >= 0])
 
-		if (index+1) % log_every == 0:
-			logging.info (f"Words processed: {index+1}, Percentage: {(index+1)/len(w2i)}")            
+			if (index+1) % log_every == 0:
+				logging.info (f"Words processed: {index+1}, Percentage: {(index+1)/len(w2i)}")            
     
 	return neighbors
 
+def allNeighbors (embeddings, dir_path, k=25, block_size=1024, threads=1, pool=None, workers=1, max_scores=50000000):
+	""" Neighbors for MAIN and every other facet from one load of the embeddings, written as arrays. """
+	rows = np.flatnonzero (embeddings.mask[embeddings.f2i["MAIN"]])
+	writeVocab (dir_path, [embeddings.vocab[i] for i in rows])
+	facet_names = ["MAIN"] + [facet for facet in embeddings if not facet == "MAIN"]
+	for facet_name in facet_names:
+		indices, sims = computeNeighbors (embeddings.facetEmbeddings (facet_name, rows), k=k, block_size=block_size, threads=threads, pool=pool, workers=workers, max_scores=max_scores)
+		writeNeighbors (dir_path, facet_name, indices, sims)
+		logging.info (f"Neighbors written for facet {facet_name}")
+
 def main (args):
-	embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file))
+	words = None
+	if args.min_count is not None:
+		words = frequentWords (os.path.join (args.dir_path, args.vocab_file), args.min_count)
+
+	if args.all_facets:
+		embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file), words=words, dtype=args.dtype)
+		with (WorkerPool (args.workers) if args.workers > 1 else contextlib.nullcontext ()) as pool:
+			allNeighbors (embeddings, args.dir_path, k=args.nearest, block_size=args.block_size, threads=args.threads, pool=pool, workers=args.workers, max_scores=args.max_scores)
+		return
+
+	# only MAIN and the requested facet are needed
+	embeddings = readEmbeddings (os.path.join (args.dir_path, args.embeddings_file), facets=["MAIN", args.facet_name], words=words, dtype=args.dtype)
 
 	# Separate the main embeddings and the facet embeddings
 	static_embeddings = embeddings["MAIN"]
@@ -56,7 +117,8 @@ def main (args):
 	else:
 		all_embeddings.append (temporal_embeddings)
 
-	neighbors = getNeighbors (all_embeddings, w2i, i2w, k=args.nearest)
+	with (WorkerPool (args.workers) if args.workers > 1 else contextlib.nullcontext ()) as pool:
+		neighbors = getNeighbors (all_embeddings, w2i, i2w, k=args.nearest, block_size=args.block_size, threads=args.threads, pool=pool, workers=args.workers, max_scores=args.max_scores)
 
 	# write the neighbors to file
 	with open (os.path.join (args.dir_path, args.near_neighbors_file), "wb") as fout:
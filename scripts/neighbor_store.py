@@ -0,0 +1,132 @@
+"""
+Compact on-disk format for near neighbors.
+
+Instead of one pickle of per-word lists of (similarity, word) tuples per facet,
+every facet gets two V x k arrays next to a shared vocabulary file:
+
+	neighbors.vocab              one word per line; row i of every array is word i
+	{facet}.neighbors.idx.npy    int32 row numbers of the neighbors, -1 past the last one
+	{facet}.neighbors.sim.npy    float32 similarities of those neighbors
+
+Row i lists the neighbors of word i in decreasing similarity, exactly as
+mylib.semantic_neighbors orders them. Existing pickles are converted once with
+
+python neighbor_store.py --dir-path ../data/aa_temp_grouped --facet-names MAIN T0 T1 T2 T3 T4 T5 T6 T7 T8 T9
+"""
+
+import argparse
+import os
+import pickle
+import logging
+import numpy as np
+
+VOCAB_FILE = "neighbors.vocab"
+
+def readArgs ():
+	parser = argparse.ArgumentParser (description="convert pickled near neighbors into arrays")
+	parser.add_argument ("--dir-path", required=True, type=str, help="directory that contains the {facet}.neighbors.pkl files")
+	parser.add_argument ("--facet-names", required=True, type=str, nargs="+", help="facets to convert")
+	args = parser.parse_args ()
+	return args
+
+def neighborPaths (dir_path, facet):
+	return {"indices": os.path.join (dir_path, f"{facet}.neighbors.idx.npy"), \
+			"sims": os.path.join (dir_path, f"{facet}.neighbors.sim.npy")}
+
+def writeVocab (dir_path, vocab):
+	with open (os.path.join (dir_path, VOCAB_FILE), "w") as fout:
+		for w in vocab:
+			fout.write (f"{w}\n")
+
+def writeNeighbors (dir_path, facet, indices, sims):
+	paths = neighborPaths (dir_path, facet)
+	np.save (paths["indices"], np.asarray (indices, dtype=np.int32))
+	np.save (paths["sims"], np.asarray (sims, dtype=np.float32))
+
+def picklePath (dir_path, facet):
+	return os.path.join (dir_path, f"{facet}.neighbors.pkl")
+
+def hasNeighbors (dir_path, facets):
+	""" True if the arrays of every facet exist and none is older than the facet's pickle. """
+	if not os.path.exists (os.path.join (dir_path, VOCAB_FILE)):
+		return False
+	for facet in facets:
+		paths = list (neighborPaths (dir_path, facet).values ())
+		if not all (os.path.exists (path) for path in paths):
+			return False
+		pickle_path = picklePath (dir_path, facet)
+		if os.path.exists (pickle_path) and os.path.getmtime (pickle_path) > min (os.path.getmtime (path) for path in paths):
+			logging.warning (f"Ignoring stale neighbor arrays for {facet} in {dir_path}")
+			return False
+	return True
+
+def readVocab (dir_path):
+	with open (os.path.join (dir_path, VOCAB_FILE)) as fin:
+		return [line.rstrip ("\n") for line in fin]
+
+class NeighborStore (object):
+	""" Read-only access to the neighbor arrays of a directory.
+
+		Each facet's arrays are memory-mapped the first time the facet is used,
+		so a lookup only touches the pages of the rows it reads.
+	"""
+	def __init__ (self, dir_path, mmap_mode="r"):
+		self.dir_path = dir_path
+		self.mmap_mode = mmap_mode
+		self.vocab = readVocab (dir_path)
+		self.w2i = {w: i for i, w in enumerate (self.vocab)}
+		self._arrays = dict ()
+
+	def arrays (self, facet):
+		""" The (indices, sims) arrays of a facet. """
+		if facet not in self._arrays:
+			paths = neighborPaths (self.dir_path, facet)
+			self._arrays[facet] = (np.load (paths["indices"], mmap_mode=self.mmap_mode), \
+								   np.load (paths["sims"], mmap_mode=self.mmap_mode))
+		return self._arrays[facet]
+
+	def neighbors (self, facet, word, k=None):
+		""" The first k neighbors of `word` in `facet` as [(similarity, word)], like mylib.semantic_neighbors; none for words outside the store. """
+		indices, sims = self.arrays (facet)
+		row = self.w2i.get (word)
+		if row is None:
+			return list ()
+		k = indices.shape[1] if k is None else k
+		return [(sims[row, j], self.vocab[n]) for j, n in enumerate (indices[row, :k]) if n >= 0]
+
+def convertPickles (dir_path, facets):
+	""" Conversion of the {facet}.neighbors.pkl files written by near_neighbors.py --facet-name.
+
+		The arrays of a directory share one vocabulary: the existing one, or the
+		words of the first pickle when there is none yet.
+	"""
+	vocab_path = os.path.join (dir_path, VOCAB_FILE)
+	vocab = readVocab (dir_path) if os.path.exists (vocab_path) else None
+	w2i = None if vocab is None else {w: i for i, w in enumerate (vocab)}
+	for facet in facets:
+		with open (picklePath (dir_path, facet), "rb") as fin:
+			neighbors = pickle.load (fin)
+		if vocab is None:
+			vocab = list (neighbors)
+			w2i = {w: i for i, w in enumerate (vocab)}
+			writeVocab (dir_path, vocab)
+		missing = {n for w, items in neighbors.items () for n in [w] + [n for _, n in items[0]] if n not in w2i}
+		if len (missing) > 0:
+			raise ValueError (f"{len (missing)} words of {facet}.neighbors.pkl are not in {vocab_path}; " \
+							  f"remove the neighbor arrays of {dir_path} to convert every facet again")
+		k = max ([len (neighbors[w][0]) for w in neighbors] + [0])
+		indices = np.full ((len (vocab), k), -1, dtype=np.int32)
+		sims = np.zeros ((len (vocab), k), dtype=np.float32)
+		for w, items in neighbors.items ():
+			for j, (s, n) in enumerate (items[0]):
+				indices[w2i[w], j] = w2i[n]
+				sims[w2i[w], j] = s
+		writeNeighbors (dir_path, facet, indices, sims)
+		logging.info (f"Converted {facet}.neighbors.pkl")
+
+def main (args):
+	logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+	convertPickles (args.dir_path, args.facet_names)
+
+if __name__ == "__main__":
+	main (readArgs ())
@@ -12,3 +12,6 @@ source constants.sh
 ### A slightly different way of comparing against randomized datasets
 
 parallel --jobs 16 python leadership_scores_new.py --rand-path ../data/$RAND_PREFIX.{1} --obs-path ../data/aa_fc_grouped --embeddings-file out.embeddings --feats-file features.txt --leaders-file leaders.{2}.{3}.csv --output-file leaders_random.{2}.{3}.csv ::: $(seq -f "%03g" 1 100) ::: 0 ::: l1
+
+# or every run in one process, into a single word x run matrix of random_lead1 values
+#python leadership_scores_new.py --rand-paths $(seq -f "../data/$RAND_PREFIX.%03g" 1 100) --obs-path ../data/aa_fc_grouped --embeddings-file out.embeddings --feats-file features.txt --leaders-file leaders.0.l1.csv --matrix-file ../data/aa_fc_grouped/leaders_random.0.l1.matrix.csv
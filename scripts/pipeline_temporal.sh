@@ -2,9 +2,12 @@
 
 ### Assume that the embeddings have been trained at the beginning of this script
 
+## Convert the embeddings into a memory-mapped store (read by every script below)
+python embedding_store.py --embeddings-file ../data/aa_temp_grouped/out.embeddings
+
 ## Find the nearest neighbors
 # Note that this step requires a few hours
-parallel python near_neighbors.py --dir-path ../data/aa_temp_grouped --embeddings-file out.embeddings --near-neighbors-file {1}.neighbors.pkl --facet-name {1} --nearest 25 ::: MAIN T0 T1 T2 T3 T4 T5 T6 T7 T8 T9
+python near_neighbors.py --dir-path ../data/aa_temp_grouped --embeddings-file out.embeddings --all-facets --nearest 25
 
 ## Find the semantic changes according to the "local" metric for change
 python local_dynamic_ranks.py --dir-path ../data/aa_temp_grouped --embeddings-file out.embeddings --scores-file local.scores
@@ -0,0 +1,108 @@
+"""
+Report how far lead scores and near neighbors move when the pipeline runs at a
+reduced precision (--dtype in leadership_scores.py, near_neighbors.py, ...)
+instead of float64.
+
+python precision_check.py --src-path ../data/aa_fc_grouped --temp-path ../data/aa_temp_grouped --embeddings-file out.embeddings --feats-file features.txt --changes-file words.csv --dtype float32
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import logging
+from helpful_functions import readEmbeddings, normalize, MAIN_FEAT
+from embedding_store import DTYPES
+from leadership_scores import readFeats, candidate_vocab, get_lead_embeddings, get_leader_dyads
+from mylib import semantic_neighbors
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+
+def readArgs ():
+	parser = argparse.ArgumentParser (description="accuracy of reduced precision embeddings against float64")
+	parser.add_argument ("--src-path", type=str, required=True, help="directory that contains the source embeddings")
+	parser.add_argument ("--temp-path", type=str, required=True, help="directory that contains the temporal embeddings and other files")
+	parser.add_argument ("--embeddings-file", type=str, required=True, help="embeddings file (in both directories)")
+	parser.add_argument ("--feats-file", type=str, required=True, help="listing the features in a file")
+	parser.add_argument ("--changes-file", type=str, required=True, help="file contains all the changes")
+	parser.add_argument ("--dtype", type=str, required=True, choices=[d for d in DTYPES if d != "float64"], help="precision to check")
+	parser.add_argument ("--lead-types", type=str, nargs="+", required=False, default=["l1", "l2", "l3", "l4", "l5"], help="short codes for lead types")
+	parser.add_argument ("--facet-names", type=str, nargs="+", required=False, default=["MAIN"], help="temporal facets to compare neighbors in (default: MAIN)")
+	parser.add_argument ("--nearest", type=int, required=False, default=25, help="number of near neighbors (default: 25)")
+	parser.add_argument ("--sample", type=int, required=False, default=1000, help="number of words whose neighbors are compared (default: 1000)")
+	parser.add_argument ("--seed", type=int, required=False, default=42, help="seed for the word sample")
+	args = parser.parse_args ()
+	return args
+
+def leader_dyads (embeddings, facet_names, all_words, lead_types, dtype):
+	w2i = candidate_vocab (all_words, {w:i for i,w in enumerate (embeddings[MAIN_FEAT])})
+	i2w = {i:w for w,i in w2i.items ()}
+	sources = set ([facet[1].split("_")[1] for facet in facet_names if len (facet) > 1])
+	conditional_embeddings, normalized_embeddings = get_lead_embeddings (embeddings, w2i, i2w, facet_names, lead_types, dtype=dtype)
+	return get_leader_dyads (all_words, embeddings, conditional_embeddings, normalized_embeddings, sources, w2i, lead_types, vocab_size=embeddings.vocab_size)
+
+def compare_leads (reference, reduced):
+	""" Maximum absolute deviation of the lead values and the number of words whose leading dyad changed. """
+	deviations, changed, compared = [0.0], 0, 0
+	for w, (key, value) in reference.items ():
+		other_key, other_value = reduced.get (w, (None, None))
+		if key is None or other_key is None:
+			changed += int (key != other_key)
+			continue
+		compared += 1
+		changed += int (key != other_key)
+		deviations.append (abs (float (value) - float (other_value)))
+	return max (deviations), changed, compared
+
+def compare_neighbors (reference, reduced, words, w2i, i2w, k=25):
+	""" Maximum rank displacement, mean overlap and maximum similarity deviation of the top-k neighbors.
+
+		A float64 neighbor that drops out of the reduced top-k counts as displaced to rank k.
+	"""
+	max_shift, overlaps, max_sim = 0, list (), 0.0
+	for w in words:
+		ref = semantic_neighbors (w, reference, (w2i, i2w), k=k)
+		red = semantic_neighbors (w, reduced, (w2i, i2w), k=k)
+		red_ranks = {n: (r, s) for r, (s, n) in enumerate (red)}
+		for r, (s, n) in enumerate (ref):
+			other_rank, other_sim = red_ranks.get (n, (k, None))
+			max_shift = max (max_shift, abs (r - other_rank))
+			if other_sim is not None:
+				max_sim = max (max_sim, abs (float (s) - float (other_sim)))
+		overlaps.append (len (set (red_ranks) & {n for _, n in ref}) / max (1, len (ref)))
+	return max_shift, float (np.mean (overlaps)) if len (overlaps) > 0 else 1.0, max_sim
+
+def main (args):
+	# lead scores on the source embeddings
+	facet_names = readFeats (os.path.join (args.src_path, args.feats_file))
+	candidates = pd.read_csv (os.path.join (args.temp_path, args.changes_file), sep=";")
+	all_words = candidates[["word", "Period1", "Period2", "Freq1", "Freq2"]].values.tolist()
+	embeddings = readEmbeddings (os.path.join (args.src_path, args.embeddings_file), \
+								 facets=[name for facet in facet_names for name in facet], \
+								 words={str (item[0]) for item in all_words})
+	reduced = embeddings.astype (args.dtype)
+	reference_dyads = leader_dyads (embeddings, facet_names, all_words, args.lead_types, np.float64)
+	reduced_dyads = leader_dyads (reduced, facet_names, all_words, args.lead_types, args.dtype)
+	for lead_type in args.lead_types:
+		deviation, changed, compared = compare_leads (reference_dyads[lead_type], reduced_dyads[lead_type])
+		logging.info (f"{lead_type} at {args.dtype}: max lead deviation {deviation:.3e} over {compared} words, leading dyad changed for {changed} words")
+
+	# near neighbors on the temporal embeddings
+	embeddings = readEmbeddings (os.path.join (args.temp_path, args.embeddings_file), facets=[MAIN_FEAT] + args.facet_names)
+	static_embeddings = embeddings[MAIN_FEAT]
+	w2i = {w:i for i, w in enumerate (static_embeddings)}
+	i2w = {i:w for i, w in enumerate (static_embeddings)}
+	main_embeddings = np.array([static_embeddings[i2w[i]] for i in range (len(i2w))])
+
+	rng = np.random.default_rng (args.seed)
+	words = [i2w[i] for i in rng.choice (len (i2w), size=min (args.sample, len (i2w)), replace=False)]
+	for facet_name in args.facet_names:
+		reference = main_embeddings
+		if facet_name != MAIN_FEAT:
+			reference = main_embeddings + np.array([embeddings[facet_name][i2w[i]] for i in range (len(i2w))])
+		reduced = normalize (reference.astype (args.dtype))
+		reference = normalize (reference)
+		max_shift, overlap, max_sim = compare_neighbors (reference, reduced, words, w2i, i2w, k=args.nearest)
+		logging.info (f"{facet_name} at {args.dtype}: max neighbor rank shift {max_shift}, mean top-{args.nearest} overlap {overlap:.4f}, max similarity deviation {max_sim:.3e}")
+
+if __name__ == "__main__":
+	main (readArgs ())
@@ -0,0 +1,223 @@
+"""
+Long-running query service for the facet embeddings.
+
+findNearest.py loads and normalizes everything again for every session. This
+service does it once: the normalized embeddings of all facets (MAIN plus each
+facet's deviations) stay resident as one F x V x D tensor, and a batch of query
+words is answered for every facet with a single matrix multiply. Recent answers
+are kept in an LRU cache.
+
+python query_service.py --embeddings-file ../data/aa_temp_grouped/out.embeddings --mode serve --port 8765
+
+The service speaks JSON over localhost HTTP:
+
+	GET  /neighbors?words=wicked,cool&k=10&facets=T0,T9
+	POST /neighbors  {"words": ["wicked", "cool"], "k": 10, "facets": ["T0", "T9"]}
+
+and answers {word: {facet: [[neighbor, similarity], ...]}}, words missing from
+the vocabulary mapping to null. From python (a notebook, another script):
+
+	from query_service import query
+	query (["wicked", "cool"], k=10)
+
+and `--mode query` reads words from stdin and prints them like findNearest.py.
+"""
+
+import argparse
+import sys
+import json
+import logging
+import threading
+import urllib.request
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from helpful_functions import readEmbeddings, MAIN_FEAT
+from embedding_store import DTYPES
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+def readArgs ():
+	parser = argparse.ArgumentParser (description="query service for the nearest neighbors of words across facets")
+	parser.add_argument ("--mode", required=False, type=str, default="serve", choices=["serve", "query"], help="run the service or query a running one from stdin (default: serve)")
+	parser.add_argument ("--embeddings-file", required=False, type=str, default=None, help="embeddings file (required to serve)")
+	parser.add_argument ("--host", required=False, type=str, default="127.0.0.1", help="address to serve on (default: 127.0.0.1)")
+	parser.add_argument ("--port", required=False, type=int, default=8765, help="port to serve on or query (default: 8765)")
+	parser.add_argument ("--facet-names", required=False, type=str, nargs="+", default=None, help="facets to serve or query (default: all)")
+	parser.add_argument ("--k", required=False, type=int, default=10, help="number of neighbors (default: 10)")
+	parser.add_argument ("--dtype", required=False, type=str, default="float32", choices=DTYPES, help="precision of the resident tensor (default: float32)")
+	parser.add_argument ("--cache-size", required=False, type=int, default=10000, help="number of cached answers (default: 10000)")
+	parser.add_argument ("--max-scores", required=False, type=int, default=50000000, help="bound on the similarities computed by one multiply (default: 5e7)")
+	args = parser.parse_args ()
+	if args.mode == "serve" and args.embeddings_file is None:
+		parser.error ("--embeddings-file is required to serve")
+	return args
+
+class LRUCache (object):
+	""" A bounded mapping that forgets the least recently used keys first. """
+	def __init__ (self, size):
+		self.size = size
+		self.items = OrderedDict ()
+		self.lock = threading.Lock ()
+
+	def get (self, key):
+		with self.lock:
+			if key not in self.items:
+				return None
+			self.items.move_to_end (key)
+			return self.items[key]
+
+	def put (self, key, value):
+		with self.lock:
+			self.items[key] = value
+			self.items.move_to_end (key)
+			while len (self.items) > self.size:
+				self.items.popitem (last=False)
+
+class FacetTensor (object):
+	""" Normalized embeddings of every facet stacked into one (F, V, D) tensor. """
+	def __init__ (self, embeddings, facets=None, dtype="float32", cache_size=10000, max_scores=50000000):
+		rows = np.flatnonzero (embeddings.mask[embeddings.f2i[MAIN_FEAT]])
+		self.facets = list (embeddings) if facets is None else facets
+		self.f2i = {f: i for i, f in enumerate (self.facets)}
+		self.vocab = [embeddings.vocab[i] for i in rows]
+		self.w2i = {w: i for i, w in enumerate (self.vocab)}
+		self.tensor = np.empty ((len (self.facets), len (rows), embeddings.array.shape[2]), dtype=dtype)
+		for i, facet in enumerate (self.facets):
+			self.tensor[i] = embeddings.facetEmbeddings (facet, rows)
+		self.cache = LRUCache (cache_size)
+		self.max_scores = max_scores
+
+	def _search (self, rows, k):
+		""" (F, len (rows), k) neighbor ids and similarities, one multiply per batch of rows. """
+		F, V, _ = self.tensor.shape
+		k = min (k, V)
+		ids = np.empty ((F, len (rows), k), dtype=np.int64)
+		sims = np.empty ((F, len (rows), k), dtype=self.tensor.dtype)
+		batch = max (1, self.max_scores // (F * V))
+		for start in range (0, len (rows), batch):
+			stop = min (start + batch, len (rows))
+			# (F, b, D) x (F, D, V) -> (F, b, V)
+			scores = np.matmul (self.tensor[:, rows[start:stop]], self.tensor.transpose (0, 2, 1))
+			top = np.argpartition (-scores, k - 1, axis=2)[:, :, :k]
+			top_scores = np.take_along_axis (scores, top, axis=2)
+			order = np.argsort (-top_scores, axis=2, kind="stable")
+			ids[:, start:stop] = np.take_along_axis (top, order, axis=2)
+			sims[:, start:stop] = np.take_along_axis (top_scores, order, axis=2)
+		return ids, sims
+
+	def neighbors (self, words, k=10, facets=None):
+		""" {word: {facet: [(neighbor, similarity)]}} for a batch of words; None for unknown words. """
+		facets = self.facets if facets is None else facets
+		answers = {w: self.cache.get ((w, k)) for w in words if w in self.w2i}
+		missing = [w for w, answer in answers.items () if answer is None]
+		if len (missing) > 0:
+			ids, sims = self._search (np.array ([self.w2i[w] for w in missing]), k)
+			for j, w in enumerate (missing):
+				answers[w] = {f: [(self.vocab[n], float (s)) for n, s in zip (ids[i, j], sims[i, j])] \
+							  for i, f in enumerate (self.facets)}
+				self.cache.put ((w, k), answers[w])
+		return {w: {f: answers[w][f] for f in facets if f in answers[w]} if w in answers else None for w in words}
+
+def makeHandler (tensor):
+	class Handler (BaseHTTPRequestHandler):
+		def _answer (self, request):
+			if not isinstance (request, dict):
+				self.send_error (400, "expected a JSON object")
+				return
+			words = request.get ("words", [])
+			if isinstance (words, str):
+				words = [w for w in words.split (",") if len (w) > 0]
+			facets = request.get ("facets", None)
+			if isinstance (facets, str):
+				facets = facets.split (",")
+			if not isinstance (words, list) or not (facets is None or isinstance (facets, list)):
+				self.send_error (400, "words and facets must be lists")
+				return
+			unknown = [f for f in (facets or []) if f not in tensor.f2i]
+			if len (unknown) > 0:
+				self.send_error (400, f"unknown facets: {unknown}")
+				return
+			try:
+				body = json.dumps (tensor.neighbors (words, k=int (request.get ("k", 10)), facets=facets)).encode ("utf-8")
+			except (ValueError, TypeError) as e:
+				self.send_error (400, str (e))
+				return
+			self.send_response (200)
+			self.send_header ("Content-Type", "application/json")
+			self.send_header ("Content-Length", str (len (body)))
+			self.end_headers ()
+			self.wfile.write (body)
+
+		def do_GET (self):
+			url = urllib.parse.urlparse (self.path)
+			if url.path != "/neighbors":
+				self.send_error (404)
+				return
+			self._answer ({key: values[-1] for key, values in urllib.parse.parse_qs (url.query).items ()})
+
+		def do_POST (self):
+			if self.path != "/neighbors":
+				self.send_error (404)
+				return
+			try:
+				request = json.loads (self.rfile.read (int (self.headers.get ("Content-Length", 0))))
+			except ValueError as e:
+				self.send_error (400, str (e))
+				return
+			self._answer (request)
+
+		def log_message (self, format, *args):
+			logging.debug (format % args)
+
+	return Handler
+
+def serve (tensor, host="127.0.0.1", port=8765):
+	server = ThreadingHTTPServer ((host, port), makeHandler (tensor))
+	logging.info (f"Serving {len (tensor.facets)} facets x {len (tensor.vocab)} words on http://{host}:{port}/neighbors")
+	try:
+		server.serve_forever ()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close ()
+
+def query (words, k=10, facets=None, url=DEFAULT_URL):
+	""" Ask a running service for the neighbors of `words`; {word: {facet: [[neighbor, similarity]]}}. """
+	request = {"words": list (words), "k": k}
+	if facets is not None:
+		request["facets"] = list (facets)
+	data = json.dumps (request).encode ("utf-8")
+	req = urllib.request.Request (f"{url}/neighbors", data=data, headers={"Content-Type": "application/json"})
+	with urllib.request.urlopen (req) as fin:
+		return json.loads (fin.read ())
+
+def main (args):
+	if args.mode == "serve":
+		embeddings = readEmbeddings (args.embeddings_file)
+		tensor = FacetTensor (embeddings, facets=args.facet_names, dtype=args.dtype, cache_size=args.cache_size, max_scores=args.max_scores)
+		serve (tensor, host=args.host, port=args.port)
+		return
+
+	url = f"http://{args.host}:{args.port}"
+	print ("query (ctrl-c to quit): ")
+	line = sys.stdin.readline()
+	while line:
+		word = line.rstrip()
+		print (word)
+		answer = query ([word], k=args.k, facets=args.facet_names, url=url)[word]
+		if answer is None:
+			print (f"{word} not in vocab")
+		else:
+			for facet in sorted (answer):
+				print (f"Finding: {word} in {facet}")
+				for w, sim in answer[facet]:
+					print (f"{w}\t{sim:.3f}")
+				print ()
+		print ("query (ctrl-c to quit): ")
+		line = sys.stdin.readline()
+
+if __name__ == "__main__":
+	main (readArgs ())
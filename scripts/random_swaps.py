@@ -2,16 +2,18 @@ import argparse
 import pandas as pd
 import os
 import random
-from random import choices, sample
+import logging
+import multiprocessing
+import heapq
 import numpy as np
 from collections import defaultdict, Counter
-from itertools import combinations
 from helpful_functions import safe_open_w
+logging.basicConfig (format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 
 def readArgs ():
 	parser = argparse.ArgumentParser (description="swapping code ")
 	parser.add_argument ("--src-file", type=str, required=True, help="file contains all the observed data")
-	parser.add_argument ("--tgt-file", type=str, required=True, help="file contains all the randomly permuted data")
+	parser.add_argument ("--tgt-file", type=str, required=True, help="file contains all the randomly permuted data; with --replicates, a format string for the replicate number (e.g. ../data/rand.{:03d}/data.txt)")
 	parser.add_argument ("--chunk-size", type=int, required=False, default=1000, help="size of each document")
 	parser.add_argument ("--max-source-size", type=int, required=False, default=None, help="total overall tokens for a source-time combination")
 	parser.add_argument("--keep-all", dest="keep_all", action="store_true")
@@ -24,10 +26,22 @@ def readArgs ():
 	parser.add_argument("--not-always-activated", dest="always_activated", action="store_false")
 	parser.set_defaults(always_activated=False)
 
+	parser.add_argument("--streaming", dest="streaming", action="store_true", help="read the data as a stream and keep only the sampled chunks (about --max-source-size tokens per epoch-source) in memory; the data is read a second time if a source first appears after the sample of its epoch was cut down")
+
+	parser.add_argument ("--replicates", type=int, required=False, default=None, help="number of permuted corpora to write from one pass over the data")
+	parser.add_argument ("--first-replicate", type=int, required=False, default=1, help="number of the first replicate (default: 1)")
+	parser.add_argument ("--seed", type=int, required=False, default=None, help="seed of the replicates; replicate r draws from SeedSequence (seed, spawn_key=(r,))")
+	parser.add_argument ("--workers", type=int, required=False, default=None, help="number of replicates written in parallel (default: all cores)")
 
 	args = parser.parse_args ()
 	if not args.keep_all and len(args.epochs) == 0:
 		parser.error('must have non-zero number --epochs when --no-keep-all')
+	if args.replicates is not None:
+		if args.streaming:
+			parser.error ("--replicates is not supported with --streaming")
+		numbers = range (args.first_replicate, args.first_replicate + args.replicates)
+		if len ({args.tgt_file.format (r) for r in numbers}) < args.replicates:
+			parser.error ("--tgt-file needs a placeholder for the replicate number (e.g. {:03d}) with --replicates")
 	return args
 
 def chunks(lst, n):
@@ -71,17 +85,16 @@ def read_data (filename, chunk_size=1000):
 	df = pd.DataFrame (rows, columns=["epoch", "orig_source", "text"])
 	return df
 
-def transform_by_permuting (df):
+def transform_by_permuting (df, rng=None):
 	# add modified_src column
 	df["mod_source"] = df["orig_source"]
 	
 	# Per epoch, print the initial source distribution
 	epochs = df["epoch"].unique()
-	src_dist = dict ()
 	sources = list ()
 	for epoch in epochs:
 		epoch_sources = df[df["epoch"] == epoch]["mod_source"].values
-		new_sources = np.random.permutation (epoch_sources)
+		new_sources = np.random.permutation (epoch_sources) if rng is None else rng.permutation (epoch_sources)
 		sources.append (new_sources)
 		
 	# assign the new sources
@@ -89,117 +102,198 @@ def transform_by_permuting (df):
 	return df
 
 
-def select_docs (df, max_docs=None):
+def group_codes (df):
+	""" Integer codes of the epochs, of the modified sources and of the epoch-source groups (in order of appearance). """
+	epoch_codes, epochs = pd.factorize (df["epoch"])
+	source_codes, sources = pd.factorize (df["mod_source"])
+	groups, _ = pd.factorize (epoch_codes * max (1, len (sources)) + source_codes)
+	return epoch_codes, epochs, source_codes, sources, groups
+
+def grouped_rows (df, keep, epoch_codes, groups):
+	""" The kept rows ordered by epoch, then source, then their position, as the epoch-source dictionaries listed them. """
+	order = np.lexsort ((groups, epoch_codes))
+	order = order[keep[order]]
+	return pd.DataFrame ({"epoch": df["epoch"].values[order], \
+						  "mod_source": df["mod_source"].values[order], \
+						  "orig_source": df["orig_source"].values[order], \
+						  "text": df["text"].values[order]})
+
+def select_docs (df, max_docs=None, rng=None):
 	if max_docs is None:
 		return df
 
-	# reorient into a epoch-source dictionary
-	data = dict ()
-	for index, row in df.iterrows():
-		epoch, mod_source = row["epoch"], row["mod_source"]
-		if epoch not in data:
-			data[epoch] = dict ()
-		if mod_source not in data[epoch]:
-			data[epoch][mod_source] = list ()
+	# a uniform sample of max_docs rows in every epoch-source combination:
+	# the rows of each group with the smallest random keys
+	epoch_codes, _, _, _, groups = group_codes (df)
+	rng = np.random if rng is None else rng
+	order = np.lexsort ((rng.random (len (df)), groups))
+	sizes = np.bincount (groups, minlength=groups.max () + 1 if len (groups) > 0 else 0)
+	starts = np.concatenate ([[0], np.cumsum (sizes)[:-1]]).astype (int)
+	ranks = np.empty (len (df), dtype=int)
+	ranks[order] = np.arange (len (df)) - starts[groups[order]]
+	return grouped_rows (df, ranks < max_docs, epoch_codes, groups)
 
-		data[epoch][mod_source].append ((row["orig_source"], row["text"]))
-		
-		
-	# now sweep over every epoch one at a time; then every source one at a time;
-	# and then select a sample for each combination 
-	modified_rows = list ()
-	for epoch in data:
-		for source in data[epoch]:
-			if len (data[epoch][source]) <= max_docs:
-				# just copy everything
-				for item in data[epoch][source]:
-					modified_rows.append ([epoch, source, item[0], item[1]])
-			else:
-				items = sample (data[epoch][source], max_docs)
-				for item in items:
-					modified_rows.append ([epoch, source, item[0], item[1]])
+def select_based_on_time (df, epochs, activated_throughout=False):	
+	epoch_codes, epoch_names, source_codes, sources, groups = group_codes (df)
+	present = np.zeros ((len (epoch_names), len (sources)), dtype=bool)
+	present[epoch_codes, source_codes] = True
 
-	
-	mod_df = pd.DataFrame (modified_rows, columns=["epoch", "mod_source", "orig_source", "text"])
-	return mod_df
+	# the selected epochs (all of them when none are given)
+	if len (epochs) > 0:
+		selected = np.isin (epoch_names, epochs)
+		n_epochs = len (epochs)
+	else:
+		selected = np.ones (len (epoch_names), dtype=bool)
+		n_epochs = len (epoch_names)
 
-def select_based_on_time (df, epochs, activated_throughout=False):	
-	# reorient into an epoch-source dictionary
-	data = dict ()
-	for index, row in df.iterrows():
-		epoch, mod_source = row["epoch"], row["mod_source"]
-		if epoch not in data:
-			data[epoch] = dict ()
-		if mod_source not in data[epoch]:
-			data[epoch][mod_source] = list ()
-
-		data[epoch][mod_source].append ((row["orig_source"], row["text"]))
-
-	# now select only the relevant source-epoch pairs
-	if len(epochs) > 0 and activated_throughout:
-		# there are a few selected epochs and we want all sources 
-		# that are activated throughout them
-		source_map = dict ()
-		for epoch in data:
-			if epoch in epochs:
-				for source in data[epoch]:
-					if source not in source_map:
-						source_map[source] = list ()
-					source_map[source].append (epoch)
-
-		relevant_sources = {key for key in source_map if len(source_map[key]) == len (epochs)}
-
-	elif len (epochs) > 0:
-		# there are few selected epochs and we select all sources within those epochs
-		relevant_sources = set ()
-		for epoch in data:
-			if epoch in epochs:
-				for source in data[epoch]:
-					relevant_sources.add (source)
-
-	elif activated_throughout:
-		# there are not selected epochs but we only want those sources that are activated throughout
-		source_map = dict ()
-		for epoch in data:
-			epochs.append (epoch)
-			for source in data[epoch]:
-				if source not in source_map:
-					source_map[source] = list ()
-				source_map[source].append (epoch)
-
-		relevant_sources = {key for key in source_map if len(source_map[key]) == len (epochs)}
+	if activated_throughout:
+		# only the sources that are activated in every selected epoch
+		relevant_sources = present[selected].sum (axis=0) == n_epochs
 	else:
-		# select everything
-		relevant_sources = set ()
-		for epoch in data:
-			epochs.append (epoch)
-			for source in data[epoch]:
-				relevant_sources.add (source)
-
-	# now create a dataframe out of it
-	modified_rows = list ()
-	for epoch in data:
-		for source in data[epoch]:
-			if epoch in epochs and source in relevant_sources:
-				for item in data[epoch][source]:
-					modified_rows.append ([epoch, source, item[0], item[1]])
-		
-	mod_df = pd.DataFrame (modified_rows, columns=["epoch", "mod_source", "orig_source", "text"])
-	return mod_df
+		# all sources within the selected epochs
+		relevant_sources = present[selected].any (axis=0)
 
-def write_data (df, filename):
+	keep = selected[epoch_codes] & relevant_sources[source_codes]
+	return grouped_rows (df, keep, epoch_codes, groups)
+
+def write_data (df, filename, block_size=100000):
 	with safe_open_w (filename) as fout:
-		for index, row in df.iterrows():
-			tokens = " ".join (row["text"])
-			epoch = row["epoch"]
-			src = row["mod_source"]
-			orig = row["orig_source"]
-			intersection = f"{epoch}_{src}"
-			fout.write (f"{orig}\t{epoch}\t{intersection}\t{tokens}\n")
+		for start in range (0, len (df), block_size):
+			block = df.iloc[start:start + block_size]
+			tokens = pd.Series ([text if isinstance (text, str) else " ".join (text) for text in block["text"]], index=block.index)
+			lines = block["orig_source"] + "\t" + block["epoch"] + "\t" + block["epoch"] + "_" + block["mod_source"] + "\t" + tokens + "\n"
+			fout.write ("".join (lines))
+
+def stream_chunks (filename, chunk_size=1000, epochs=None):
+	""" Yield the (epoch, source, tokens) chunks read_data makes as the file is read, only of `epochs` if given. """
+	buffers = dict ()
+	with open (filename) as fin:
+		for line in fin:
+			parts = line.strip().split ("\t")
+			epoch = parts[1]
+			if epochs is not None and epoch not in epochs:
+				continue
+			source = parts[2].split ("_")[1]
+			buffer = buffers.setdefault ((epoch, source), list ())
+			buffer.extend (parts[3].split())
+			start = 0
+			while len (buffer) - start >= chunk_size:
+				yield epoch, source, buffer[start:start + chunk_size]
+				start += chunk_size
+			del buffer[:start]
+
+	# the last, shorter chunk of every group
+	for (epoch, source), buffer in buffers.items ():
+		if len (buffer) > 0:
+			yield epoch, source, buffer
+
+def smallest_keys (chunks, seed, max_docs=None, capacities=None):
+	""" Per epoch, a heap of (-key, i, source, text) of all the chunks with a smaller random key than any dropped one, and the chunks per source. """
+	rng = random.Random (seed)
+	counts, heaps, thresholds = dict (), dict (), dict ()
+	# sources mostly recur across epochs, so every epoch keeps room for all the sources seen yet
+	sources = set ()
+	for i, (epoch, source, tokens) in enumerate (chunks):
+		# a key for every chunk, so that another pass draws the same keys
+		key = rng.random ()
+		if capacities is not None and epoch not in capacities:
+			continue
+		n = counts.setdefault (epoch, Counter ())
+		n[source] += 1
+		sources.add (source)
+		heap = heaps.setdefault (epoch, list ())
+		if key < thresholds.get (epoch, 1.0):
+			heapq.heappush (heap, (-key, i, source, " ".join (tokens)))
+			capacity = capacities[epoch] if capacities is not None else None if max_docs is None else len (sources) * max_docs
+			if capacity is not None and len (heap) > capacity:
+				thresholds[epoch] = -heapq.heappop (heap)[0]
+	return heaps, counts
+
+def reservoir_sample (read_chunks, max_docs=None, seed=None):
+	""" Per epoch, a uniform sample of as many chunks as select_docs keeps, as [(source, text)], and the chunks per source. """
+	seed = random.getrandbits (64) if seed is None else seed
+	heaps, counts = smallest_keys (read_chunks (), seed, max_docs=max_docs)
+	sizes = {epoch: sum (n if max_docs is None else min (n, max_docs) for n in counts[epoch].values ()) for epoch in counts}
+	short = {epoch: sizes[epoch] for epoch in heaps if len (heaps[epoch]) < sizes[epoch]}
+	if len (short) > 0:
+		logging.info (f"Reading the data again for the sample of {len (short)} epochs")
+		heaps.update (smallest_keys (read_chunks (), seed, capacities=short)[0])
+	return {epoch: [(source, text) for _, _, source, text in heapq.nlargest (sizes[epoch], heap)] for epoch, heap in heaps.items ()}, counts
+
+def select_sources (epoch_sources, epochs, activated_throughout=False):
+	""" The epochs and the sources to keep in them, decided like select_based_on_time. """
+	if len (epochs) == 0:
+		epochs = list (epoch_sources)
+	selected = [epoch for epoch in epoch_sources if epoch in epochs]
+	if activated_throughout:
+		counts = Counter (source for epoch in selected for source in epoch_sources[epoch])
+		relevant_sources = {source for source in counts if counts[source] == len (epochs)}
+	else:
+		relevant_sources = {source for epoch in selected for source in epoch_sources[epoch]}
+	return {epoch: [source for source in epoch_sources[epoch] if source in relevant_sources] for epoch in selected}
+
+def stream_permuted (src_file, tgt_file, chunk_size=1000, max_docs=None, epochs=None, activated_throughout=False):
+	""" random_swaps over a stream of src_file, holding only the sampled chunks (see reservoir_sample) in memory. """
+	samples, counts = reservoir_sample (lambda: stream_chunks (src_file, chunk_size, epochs=epochs), max_docs)
+	sizes = {epoch: {source: n if max_docs is None else min (n, max_docs) for source, n in counts[epoch].items ()} for epoch in counts}
+	epoch_sources = {epoch: [source for source in sizes[epoch] if sizes[epoch][source] > 0] for epoch in sizes}
+	kept = epoch_sources if epochs is None else select_sources (epoch_sources, list (epochs), activated_throughout)
+
+	with safe_open_w (tgt_file) as fout:
+		for epoch in kept:
+			# permute over all the sources of the epoch, then keep the selected ones
+			mod_sources = np.random.permutation ([source for source in epoch_sources[epoch] for _ in range (sizes[epoch][source])])
+			for (orig, tokens), src in zip (samples[epoch], mod_sources):
+				if src in kept[epoch]:
+					fout.write (f"{orig}\t{epoch}\t{epoch}_{src}\t{tokens}\n")
+
+# the chunked data, inherited by the forked replicate workers
+_chunks = None
+
+def write_replicate (job):
+	""" Permute, select and write one replicate of the chunked data with its own Generator. """
+	replicate, seed, tgt_file, max_docs, epochs, activated_throughout = job
+	rng = np.random.default_rng (np.random.SeedSequence (seed, spawn_key=(replicate,)))
+	df = transform_by_permuting (_chunks.copy (), rng=rng)
+	df = select_docs (df, max_docs=max_docs, rng=rng)
+	if epochs is not None:
+		df = select_based_on_time (df, list (epochs), activated_throughout)
+	write_data (df, tgt_file.format (replicate))
+	return replicate
+
+def write_replicates (df, tgt_file, replicates, first_replicate=1, seed=None, max_docs=None, epochs=None, activated_throughout=False, workers=None):
+	""" Write `replicates` permuted corpora of the same chunks; replicate r draws from
+		SeedSequence (seed, spawn_key=(r,)), so any one of them can be written again alone. """
+	global _chunks
+	if seed is None:
+		seed = np.random.SeedSequence ().entropy
+		logging.info (f"Seed of the replicates: {seed}")
+	workers = os.cpu_count () if workers is None else workers
+	jobs = [(r, seed, tgt_file, max_docs, epochs, activated_throughout) for r in range (first_replicate, first_replicate + replicates)]
+	_chunks = df
+	try:
+		with multiprocessing.get_context ("fork").Pool (max (1, min (workers, replicates))) as pool:
+			for replicate in pool.imap_unordered (write_replicate, jobs):
+				logging.info (f"Wrote replicate {replicate} to {tgt_file.format (replicate)}")
+	finally:
+		_chunks = None
 
 def main (args):
+	if args.streaming:
+		max_docs = None if args.max_source_size is None else int(args.max_source_size/args.chunk_size)
+		stream_permuted (args.src_file, args.tgt_file, chunk_size=args.chunk_size, max_docs=max_docs, \
+						 epochs=None if args.keep_all else args.epochs, activated_throughout=args.always_activated)
+		return
+
 	# load data and create per source document chunks
 	df = read_data (args.src_file, chunk_size=args.chunk_size)
+	if args.replicates is not None:
+		write_replicates (df, args.tgt_file, args.replicates, first_replicate=args.first_replicate, seed=args.seed, \
+						  max_docs=int(args.max_source_size/args.chunk_size), \
+						  epochs=None if args.keep_all else args.epochs, activated_throughout=args.always_activated, \
+						  workers=args.workers)
+		return
+
 	new_df = transform_by_permuting (df)
 	
 	# restrict to max number of documents per source in every epoch
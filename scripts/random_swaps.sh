@@ -4,3 +4,6 @@ parallel python random_swaps.py --src-file ../data/aa_fc_grouped/data.txt --tgt-
 
 parallel cp ../data/aa_fc_grouped/features.txt ../data/aa_fc_sampled_limited_uneven_rand.{1}/features.txt ::: $(seq -w 1 100)
 parallel cp ../data/aa_fc_grouped/vocab.txt ../data/aa_fc_sampled_limited_uneven_rand.{1}/vocab.txt ::: $(seq -w 1 100)
+
+# or chunk the data once and write all the replicates from one process (replicate r is reproducible from --seed alone)
+#python random_swaps.py --src-file ../data/aa_fc_grouped/data.txt --tgt-file "../data/aa_fc_sampled_limited_uneven_rand.{:03d}/data.txt" --chunk-size 500 --max-source-size 100000 --no-keep-all --not-always-activated --epochs T5 T6 T7 --replicates 100 --seed 20240101
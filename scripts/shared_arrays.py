@@ -0,0 +1,103 @@
+"""
+Process pools over read-only numpy arrays in multiprocessing.shared_memory.
+
+The arrays are copied into shared memory once by the parent; every job only
+carries the names of the blocks it reads, and a worker attaches to each block
+the first time it sees it. Jobs cover disjoint row ranges and their results
+stream back as they finish, for the caller to merge:
+
+	with SharedArrays ({"embs": embs}) as shared, WorkerPool (8) as pool:
+		for (start, stop), result in pool.imap (function, shared.specs, wordRanges (len (embs), 8)):
+			...
+
+where function (arrays, start, stop) receives the dict of attached arrays.
+
+NOTE: Every worker should run single threaded; start the scripts with
+OMP_NUM_THREADS=1 (or the MKL/OpenBLAS equivalent) so the BLAS threads of the
+workers do not compete for the same cores.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+def wordRanges (n_rows, workers, chunks_per_worker=4):
+	""" Split [0, n_rows) into about workers * chunks_per_worker consecutive ranges. """
+	n_ranges = max (1, min (n_rows, workers * chunks_per_worker))
+	bounds = np.linspace (0, n_rows, n_ranges + 1).astype (int)
+	return [(int (start), int (stop)) for start, stop in zip (bounds[:-1], bounds[1:]) if stop > start]
+
+class SharedArrays (object):
+	""" Copies of named arrays in shared memory, released when the context exits. """
+	def __init__ (self, arrays=None):
+		self.blocks = list ()
+		self.specs = dict ()
+		for name, array in (dict () if arrays is None else arrays).items ():
+			self.add (name, array)
+
+	def add (self, name, array):
+		""" Copy `array` into a new block under `name`; returns the shared copy, so that the caller can let go of the original. """
+		array = np.ascontiguousarray (array)
+		block = shared_memory.SharedMemory (create=True, size=max (1, array.nbytes))
+		shared = np.ndarray (array.shape, dtype=array.dtype, buffer=block.buf)
+		shared[...] = array
+		self.blocks.append (block)
+		self.specs[name] = (block.name, array.shape, array.dtype.str)
+		return shared
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *exc):
+		self.close ()
+
+	def close (self):
+		for block in self.blocks:
+			try:
+				block.close ()
+			except BufferError:
+				# arrays returned by add are still alive (e.g. while an exception
+				# unwinds); the block is unmapped once they go
+				pass
+			block.unlink ()
+		self.blocks = list ()
+
+# blocks attached by this worker, by name
+_attached = dict ()
+
+def attach (specs):
+	""" The arrays described by `specs`, attaching to their shared blocks on first use. """
+	# let go of the blocks of earlier jobs (e.g. another facet), which the parent may have released
+	current = {block_name for block_name, _, _ in specs.values ()}
+	for block_name in [block_name for block_name in _attached if block_name not in current]:
+		_attached.pop (block_name).close ()
+	arrays = dict ()
+	for name, (block_name, shape, dtype) in specs.items ():
+		if block_name not in _attached:
+			_attached[block_name] = shared_memory.SharedMemory (name=block_name)
+		array = np.ndarray (shape, dtype=dtype, buffer=_attached[block_name].buf)
+		array.flags.writeable = False
+		arrays[name] = array
+	return arrays
+
+def _run (job):
+	function, specs, start, stop, extra = job
+	return (start, stop), function (attach (specs), start, stop, **extra)
+
+class WorkerPool (object):
+	""" A process pool whose jobs run function (arrays, start, stop, **extra) over shared arrays. """
+	def __init__ (self, workers):
+		# started before the workers so that they share it with the parent, which owns the blocks
+		resource_tracker.ensure_running ()
+		self.pool = multiprocessing.Pool (workers)
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *exc):
+		self.pool.close ()
+		self.pool.join ()
+
+	def imap (self, function, specs, ranges, **extra):
+		""" ((start, stop), result) for every range, in the order the jobs finish. """
+		return self.pool.imap_unordered (_run, [(function, specs, start, stop, extra) for start, stop in ranges])
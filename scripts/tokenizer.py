@@ -0,0 +1,49 @@
+"""
+Tokenization shared by the ingestion (makeAAOneFile.py) and counting
+(get_frequency_stats.py) scripts.
+
+Everything is done with translate tables and precompiled patterns that run
+once over the whole text instead of once per token:
+
+	clean           the punctuation cleanup of helpful_functions.basic_preprocess
+	tokenize_batch  the whitespace tokens of many documents that are valid words
+	                (a letter followed by letters or hyphens), lowercased
+	count_batch     the token counts of many tokenized documents
+"""
+
+import re
+from collections import Counter
+
+# basic_preprocess: punctuation that becomes a space and quotes that are dropped
+_CLEAN_TABLE = str.maketrans ({",": " ", ".": " ", ";": " ", ":": " ", "!": " ", "?": " ", \
+							   "[": " ", "]": " ", "{": " ", "}": " ", "\u2014": " ", \
+							   "'": None, '"': None, "\u201D": None, "\u201C": None})
+_CURRENCY = re.compile (r"\$\d+(?:\.\d+)?")
+_NUMBER = re.compile (r"^(\d+)$")
+
+# separates documents in a batch; it is whitespace, so it never joins two tokens
+_DOC_SEP = "\x1e"
+# a whole whitespace-delimited token made of a letter followed by letters or hyphens, or a separator
+_VALID_WORD_OR_SEP = re.compile (r"(?<!\S)[A-Za-z][A-Za-z-]*(?!\S)|\x1e")
+
+def clean (text):
+	""" Same output as the chain of replacements in helpful_functions.basic_preprocess. """
+	text = text.translate (_CLEAN_TABLE)
+	# replace $ amounts by special token
+	text = _CURRENCY.sub ("<currency>", text)
+	# replace numbers by special token
+	return _NUMBER.sub ("<number>", text)
+
+def tokenize_batch (texts):
+	""" The lowercased valid words of every document, in order, with a single pattern pass. """
+	if len (texts) == 0:
+		return list ()
+	texts = [text.replace (_DOC_SEP, " ") for text in texts]
+	# lowercase after matching: only ASCII letters survive the match, and
+	# lowercasing them never changes which tokens are valid
+	matches = _VALID_WORD_OR_SEP.findall (_DOC_SEP.join (texts))
+	return [doc.split () for doc in " ".join (matches).lower ().split (_DOC_SEP)]
+
+def count_batch (texts):
+	""" Token counts of already tokenized (whitespace separated) documents, splitting each only once. """
+	return [Counter (text.split ()) for text in texts]